@@ -42,7 +42,15 @@ def create_app(test_config=None):
     )
     app.config["version"] = rev.stdout
 
+    from . import httpclient, parsing
+
+    httpclient.configure(app.config)
+    parsing.parse_cache.maxweight = app.config.get(
+        "parse_cache_size", parsing.PARSE_CACHE_SIZE
+    )
+
     from . import (
+        jobs,
         hyphenator,
         citeinspector,
         deploy,
@@ -54,6 +62,7 @@ def create_app(test_config=None):
         newautopat,
     )
 
+    app.register_blueprint(jobs.bp)
     app.register_blueprint(hyphenator.bp)
     app.register_blueprint(citeinspector.bp)
     app.register_blueprint(deploy.bp)
@@ -64,6 +73,9 @@ def create_app(test_config=None):
     app.register_blueprint(dsalerts.bp)
     app.register_blueprint(newautopat.bp)
 
+    if app.config.get("citeinspector_prewarm"):
+        citeinspector.prewarm()
+
     @app.route("/")
     def index():
         return flask.render_template("index.html")
@@ -3,18 +3,53 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 # Copyright 2019 AntiCompositeNumber
 
+import concurrent.futures
 import csv
+import itertools
 import logging
+import re
+import threading
 import time
 import urllib.parse
 import uuid
 
 import flask
 import mwparserfromhell
-import requests
-from fuzzywuzzy import fuzz
+from fuzzywuzzy import fuzz, utils as fuzz_utils
+
+try:
+    from rapidfuzz.distance import Indel
+except ImportError:  # pragma: no cover
+    Indel = None
+
+from . import cache, httpclient, jobs, parsing, retry
 
 bp = flask.Blueprint("citeinspector", __name__, url_prefix="/citeinspector")
+# Maximum number of Citoid lookups in flight at once for a single page.
+# Can be overridden with the citoid_max_workers config key.
+CITOID_MAX_WORKERS = 8
+# Citoid responses, keyed by normalized identifier. The on-disk tier is
+# enabled by setting citoid_cache_path in the config.
+citoid_cache = cache.TieredCache(cache.LRUCache(maxsize=4096, ttl=24 * 60 * 60))
+# TemplateData for citation templates, shared by every request in the worker.
+templatedata_cache = cache.LRUCache(maxsize=256, ttl=60 * 60)
+
+
+@bp.record_once
+def setup(state):
+    config = state.app.config
+    ttl = config.get("citoid_cache_ttl", 24 * 60 * 60)
+    citoid_cache.memory = cache.LRUCache(
+        maxsize=config.get("citoid_cache_size", 4096), ttl=ttl
+    )
+    if config.get("citoid_cache_path"):
+        citoid_cache.disk = cache.SQLiteCache(
+            config["citoid_cache_path"],
+            maxsize=config.get("citoid_cache_disk_size", 100000),
+            ttl=ttl,
+        )
+    templatedata_cache.ttl = config.get("templatedata_cache_ttl", 60 * 60)
+    CitoidTypeMap.ttl = config.get("templatedata_cache_ttl", 60 * 60)
 
 
 class HandledError(Exception):
@@ -37,16 +72,25 @@ def flash(message, category="message"):
         print(category + ":", message)
 
 
-def get_retry(url, session, method="get", output="object", data=None):
+def get_config(key, default=None):
+    """Get a config value from the current app, if there is one."""
+    if flask.has_app_context():
+        return flask.current_app.config.get(key, default)
+    else:
+        return default
+
+
+def get_retry(
+    url, session, method="get", output="object", data=None, extra_headers=None
+):
     """Make a request for a resource and retry if that doesn't work."""
-    headers = {
-        "user-agent": "anticompositetools/citeinspector "
-        "(https://tools.wmflabs.org/anticompositetools/citeinspector; "
-        "tools.anticompositetools@tools.wmflabs.org) python-requests/"
-        + requests.__version__
-    }
-
-    for i in range(1, 5):  # pragma: no branch
+    headers = {"user-agent": httpclient.user_agent("citeinspector")}
+    if extra_headers:
+        headers.update(extra_headers)
+
+    attempts = retry.default.start()
+    while True:
+        response = None
         try:
             if method == "get":
                 response = session.get(url, headers=headers)
@@ -55,7 +99,7 @@ def get_retry(url, session, method="get", output="object", data=None):
             else:
                 raise NotImplementedError
 
-            response.raise_for_status()
+            retry.check_response(response)
 
             if output == "json":
                 output_json = response.json()
@@ -64,7 +108,7 @@ def get_retry(url, session, method="get", output="object", data=None):
             raise
         except Exception:
             # TODO: Figure out which exceptions should be caught here.
-            if (
+            if response is not None and (
                 response.status_code in [404, 400]
                 or response.text == "upstream request timeout"
             ):
@@ -73,10 +117,9 @@ def get_retry(url, session, method="get", output="object", data=None):
                     return response
                 else:
                     return None
-            elif i == 4:
+            elif not attempts.sleep(response):
                 raise
             else:
-                time.sleep(5 * i)
                 continue
         else:
             break
@@ -104,10 +147,84 @@ def get_wikitext(url, session):
         return (request.text, (edit_time, start_time))
 
 
+class CitoidTypeMap:
+    """Process-wide copy of MediaWiki:Citoid-template-type-map.json
+
+    The map is revalidated with a conditional request once it is older than
+    ttl seconds, so an unchanged page costs a 304 instead of a download.
+    Only one request revalidates at a time; the others keep using the copy
+    they have, as does everyone if revalidation fails.
+    """
+
+    # Held while fetching, so only one request fetches at a time
+    _lock = threading.Lock()
+    value = None
+    last_modified = None
+    last_check = None
+    ttl = 60 * 60
+    # Seconds to wait before trying again after a failed revalidation
+    retry_after = 60
+
+    @classmethod
+    def stale(cls):
+        return cls.value is None or time.monotonic() - cls.last_check > cls.ttl
+
+    @classmethod
+    def get(cls, session):
+        value = cls.value
+        if not cls.stale():
+            return value
+        elif value is None:
+            # Nothing to fall back on, wait for whoever is fetching it
+            with cls._lock:
+                if cls.stale():
+                    cls.refresh(session)
+                return cls.value
+        elif not cls._lock.acquire(blocking=False):
+            # Someone else is revalidating it already
+            return value
+
+        try:
+            if cls.stale():
+                cls.refresh(session)
+        except Exception as err:
+            logging.warning(f"Unable to revalidate the Citoid type map: {err}")
+            cls.last_check = time.monotonic() - cls.ttl + cls.retry_after
+        finally:
+            cls._lock.release()
+        return cls.value
+
+    @classmethod
+    def refresh(cls, session):
+        url = (
+            f'{get_page_url("MediaWiki:Citoid-template-type-map.json")[0]}'
+            "&action=raw"
+        )
+        extra_headers = {}
+        if cls.value is not None and cls.last_modified:
+            extra_headers["If-Modified-Since"] = cls.last_modified
+
+        response = get_retry(url=url, session=session, extra_headers=extra_headers)
+        if response.status_code != 304:
+            value = response.json()
+            cls.last_modified = response.headers.get("Last-Modified")
+            # Readers don't lock, so last_check has to be set before value is
+            cls.last_check = time.monotonic()
+            cls.value = value
+        else:
+            cls.last_check = time.monotonic()
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls.value = None
+            cls.last_modified = None
+            cls.last_check = None
+
+
 def get_citoid_template_types(session):
     """Loads template to citoid type mapping from wiki"""
-    url = f'{get_page_url("MediaWiki:Citoid-template-type-map.json")[0]}' "&action=raw"
-    template_type_map = get_retry(url=url, session=session, output="json")
+    template_type_map = CitoidTypeMap.get(session)
     supported_templates = [
         template
         for key, template in template_type_map.items()
@@ -117,14 +234,27 @@ def get_citoid_template_types(session):
     return template_type_map, supported_templates
 
 
-def find_refs(code, supported_templates):
+def find_refs(code, supported_templates, wikicode_index=None):
     """Find refs in the wikitext"""
+    if wikicode_index is None:
+        wikicode_index = parsing.index(code)
+
+    # A named ref can be repeated with the same content, and a template can
+    # be repeated word for word. Each cite locates every identical copy, so
+    # /concat changes them all together.
+    ref_locators = {}
+    for i, (tag, first_template) in enumerate(wikicode_index.refs):
+        ref_locators.setdefault(str(tag), []).append(["ref", i])
+    text_locators = {}
+    for i, template in enumerate(wikicode_index.top_templates):
+        text_locators.setdefault(str(template), []).append(["text", i])
+
     # Check for <ref> tags with citation templates
-    for tag in code.ifilter_tags(matches="ref"):
-        if tag.contents.filter_templates():
+    for tag, first_template in wikicode_index.refs:
+        if first_template is not None:
             # Ignore self-closed, unparsable, and empty tags
             cite_data, template_name = grab_cite_data(
-                tag.contents.filter_templates()[0], supported_templates
+                first_template, supported_templates
             )
             if cite_data is not None:
                 try:
@@ -139,12 +269,13 @@ def find_refs(code, supported_templates):
                     template=template_name,
                     source="wikitext",
                     location="ref",
+                    locators=ref_locators[str(tag)],
                     wikitext=str(tag),
                     data=cite_data,
                 )
 
     # Check for citation templates elsewhere in the text
-    for template in code.ifilter_templates(recursive=False):
+    for template in wikicode_index.top_templates:
         cite_data, template_name = grab_cite_data(template, supported_templates)
         if cite_data is not None:
             # We could generate a Harvard anchor here, but I don't trust
@@ -155,6 +286,7 @@ def find_refs(code, supported_templates):
                 template=template_name,
                 source="wikitext",
                 location="text",
+                locators=text_locators[str(template)],
                 wikitext=str(template),
                 data=cite_data,
             )
@@ -183,7 +315,25 @@ def get_bib_ident(cite_data):
     )
 
 
+def normalize_ident(ident):
+    """Normalize an identifier so equivalent forms share a cache entry"""
+    ident = ident.strip()
+    if re.fullmatch(r"[0-9Xx][0-9Xx\- ]{8,}", ident):
+        # ISBN, ignore hyphenation
+        return ident.replace("-", "").replace(" ", "").upper()
+    elif ident.startswith("10."):
+        # DOIs are case-insensitive
+        return ident.lower()
+    else:
+        return ident
+
+
 def get_citoid_data(ident, session):
+    key = normalize_ident(ident)
+    data = citoid_cache.get(key)
+    if data is not None:
+        return data
+
     rest_api = "https://en.wikipedia.org/api/rest_v1/"
 
     url = f"{rest_api}data/citation/mediawiki/{urllib.parse.quote_plus(ident)}"
@@ -192,11 +342,53 @@ def get_citoid_data(ident, session):
     except Exception:
         data = None
     if data is not None:
+        citoid_cache.set(key, data[0])
         return data[0]
     else:
         return None
 
 
+def get_citoid_data_bulk(idents, session, max_workers=None):
+    """Resolve a list of identifiers through Citoid concurrently.
+
+    Results are returned in the same order as idents, with None for
+    identifiers Citoid couldn't resolve.
+    """
+    if max_workers is None:
+        max_workers = get_config("citoid_max_workers", CITOID_MAX_WORKERS)
+    if not idents:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, len(idents)))
+    ) as executor:
+        return list(executor.map(get_citoid_data, idents, itertools.repeat(session)))
+
+
+def iter_citoid_data(refs, session, max_workers=None):
+    """Look up (old_data, ident) pairs through Citoid concurrently, yielding
+    ((old_data, ident), citoid data) in the order the lookups finish.
+    """
+    if max_workers is None:
+        max_workers = get_config("citoid_max_workers", CITOID_MAX_WORKERS)
+    if not refs:
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, len(refs)))
+    )
+    try:
+        futures = {
+            executor.submit(get_citoid_data, ident, session): (old_data, ident)
+            for old_data, ident in refs
+        }
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # Don't keep looking things up if the client has gone away
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 def map_citoid_to_templates(
     raw_citoid_data, wikitext_data, templatedata_cache, template_type_map, session
 ):
@@ -279,6 +471,37 @@ def get_TemplateData_map(template, session):
     return pages[list(pages)[0]]
 
 
+def get_TemplateData_maps(templates, session):
+    """Fetch TemplateData for several templates, 50 per API request"""
+    mw_api = "https://en.wikipedia.org/w/api.php"
+    templates = list(templates)
+    output = {}
+    for i in range(0, len(templates), 50):
+        request_body = dict(
+            action="templatedata",
+            format="json",
+            titles="|".join(
+                "Template:" + template for template in templates[i : i + 50]
+            ),
+        )
+        templatedata = get_retry(
+            mw_api, session, method="post", output="json", data=request_body
+        )
+        for page in templatedata["pages"].values():
+            output[page["title"].partition(":")[2]] = page
+    return output
+
+
+def fill_templatedata_cache(templates, session):
+    """Make sure TemplateData for all of templates is in the cache"""
+    missing = sorted(
+        {template for template in templates if template not in templatedata_cache}
+    )
+    if missing:
+        for template, templatedata in get_TemplateData_maps(missing, session).items():
+            templatedata_cache[template] = templatedata
+
+
 def concat_items(wikitext_data, citoid_data):
     """Zip wikitext and citoid data together"""
     cite = {}
@@ -293,6 +516,7 @@ def concat_items(wikitext_data, citoid_data):
         return None
     cite["citoid_source"] = citoid_data["source"]
     cite["location"] = wikitext_data["location"]
+    cite["locators"] = wikitext_data.get("locators")
     cite["ratio"] = fuzz_seq(wt_citedata.values(), ct_citedata.values())
     cite["data"] = {}
 
@@ -327,17 +551,56 @@ def concat_items(wikitext_data, citoid_data):
 
 
 def fuzz_item(item_a, item_b):
+    # Same shortcuts as fuzzywuzzy's decorators, without the call overhead
+    if item_a == item_b:
+        return 100
+    elif not item_a or not item_b:
+        return 0
     return fuzz.partial_ratio(item_a, item_b)
 
 
 def fuzz_seq(set_a, set_b):
-    str_a = ""
-    str_b = ""
-    for item in set_a:
-        str_a += item + " "
-    for item in set_b:
-        str_b += item + " "
-    return fuzz.token_set_ratio(str_a, str_b)
+    str_a = "".join(item + " " for item in set_a)
+    str_b = "".join(item + " " for item in set_b)
+    return token_set_ratio(str_a, str_b)
+
+
+# fuzzywuzzy only matches Indel's scores when it is backed by python-Levenshtein
+_fast_ratio = (
+    Indel is not None and fuzz.SequenceMatcher.__module__ == "fuzzywuzzy.StringMatcher"
+)
+
+
+def _ratio(str_a, str_b):
+    if str_a == str_b:
+        return 100
+    elif not str_a or not str_b:
+        return 0
+    return int(round(100 * Indel.normalized_similarity(str_a, str_b)))
+
+
+def token_set_ratio(str_a, str_b):
+    """fuzz.token_set_ratio, computed with rapidfuzz if it's available"""
+    if not _fast_ratio:
+        return fuzz.token_set_ratio(str_a, str_b)
+
+    # The same steps as fuzzywuzzy's _token_set()
+    proc_a = fuzz_utils.full_process(str_a, force_ascii=True)
+    proc_b = fuzz_utils.full_process(str_b, force_ascii=True)
+    if not proc_a or not proc_b:
+        return 0
+
+    tokens_a = set(proc_a.split())
+    tokens_b = set(proc_b.split())
+    sorted_sect = " ".join(sorted(tokens_a & tokens_b))
+    combined_a = (sorted_sect + " " + " ".join(sorted(tokens_a - tokens_b))).strip()
+    combined_b = (sorted_sect + " " + " ".join(sorted(tokens_b - tokens_a))).strip()
+    sorted_sect = sorted_sect.strip()
+    return max(
+        _ratio(sorted_sect, combined_a),
+        _ratio(sorted_sect, combined_b),
+        _ratio(combined_a, combined_b),
+    )
 
 
 def get_page_url(rawinput):
@@ -371,18 +634,31 @@ def get_page_url(rawinput):
     return f"https://{site}/w/index.php?title={title}", title
 
 
-def citeinspector(url):
-    session = requests.Session()
+def citeinspector(url, max_workers=None):
+    meta = {}
+    wikitext, cites = iter_citeinspector(url, meta, max_workers=max_workers)
+    output = dict(cites)
+    return output, wikitext, meta
+
+
+def iter_citeinspector(url, meta, max_workers=None, stream=False):
+    """Start inspecting a page. Returns the page's wikitext and a generator
+    of (name, citedata) for each citation matched with Citoid data.
+
+    The page is fetched and parsed before this returns, the Citoid lookups
+    happen as the generator is consumed. With stream=True, citations are
+    generated in the order Citoid answers instead of page order. Once the
+    generator is exhausted, meta has not_found set if nothing matched.
+    """
+    session = httpclient.get_session("citeinspector")
     logging.info("Processing new page: " + url)
     wikitext, times = get_wikitext(url, session)
     template_type_map, supported_templates = get_citoid_template_types(session)
 
-    templatedata_cache = {}
-    output = {}
-    meta = {}
     found = 0
-    code = mwparserfromhell.parse(wikitext)
+    code = parsing.parse(wikitext, page=url, revision=times[0])
 
+    refs = []
     for old_data in find_refs(code, supported_templates):
         # we've found citation data, found to at least 1
         if found < 1:
@@ -393,44 +669,110 @@ def citeinspector(url):
             # we've found identifiers, found to at least 2
             if found < 2:
                 found = 2
-            raw_citoid_data = get_citoid_data(ident.strip(), session)
+            refs.append((old_data, ident.strip()))
         else:  # pragma: no cover
             # These lines have tests, but get optomised out by the compiler
             # and therefore missed by coverage
             continue
 
-        if raw_citoid_data is not None:
-            # we've got citoid data, set found to at least 3
-            if found < 3:
-                found = 3
-            citoid_data, templatedata_cache = map_citoid_to_templates(
-                raw_citoid_data,
-                old_data,
-                templatedata_cache,
-                template_type_map,
+    meta["start_time"] = times[1]
+    meta["edit_time"] = times[0]
+
+    def resolve(found):
+        if stream:
+            # Results come back in any order, so get TemplateData for every
+            # template Citoid might ask for up front (usually already cached).
+            fill_templatedata_cache(template_type_map.values(), session)
+            results = iter_citoid_data(refs, session, max_workers=max_workers)
+        else:
+            citoid_results = get_citoid_data_bulk(
+                [ident for old_data, ident in refs], session, max_workers=max_workers
+            )
+            # Get all the TemplateData this page needs in one request
+            fill_templatedata_cache(
+                {
+                    template_type_map[raw_citoid_data["itemType"]]
+                    for raw_citoid_data in citoid_results
+                    if raw_citoid_data is not None
+                    and raw_citoid_data.get("itemType") in template_type_map
+                },
                 session,
             )
-        else:  # pragma: no cover
-            continue
+            results = zip(refs, citoid_results)
+
+        for (old_data, ident), raw_citoid_data in results:
+            if raw_citoid_data is not None:
+                # we've got citoid data, set found to at least 3
+                if found < 3:
+                    found = 3
+                citoid_data, _ = map_citoid_to_templates(
+                    raw_citoid_data,
+                    old_data,
+                    templatedata_cache,
+                    template_type_map,
+                    session,
+                )
+            else:  # pragma: no cover
+                continue
 
-        citedata = concat_items(old_data, citoid_data)
-        if citedata:
-            # citoid and wikitext information were matched
-            if found < 4:
-                found = 4
-            output[old_data["name"]] = citedata
-        else:  # pragma: no cover
-            continue
+            citedata = concat_items(old_data, citoid_data)
+            if citedata:
+                # citoid and wikitext information were matched
+                if found < 4:
+                    found = 4
+                yield old_data["name"], citedata
+            else:  # pragma: no cover
+                continue
 
-    meta["start_time"] = times[1]
-    meta["edit_time"] = times[0]
-    if found < 4:
-        # When found < 4, something wasn't found.
-        # Add what should have been found next to meta
-        meta["not_found"] = ("refs", "ident", "data", "para")[found]
-    session.close()
+        if found < 4:
+            # When found < 4, something wasn't found.
+            # Add what should have been found next to meta
+            meta["not_found"] = ("refs", "ident", "data", "para")[found]
 
-    return output, wikitext, meta
+    return wikitext, resolve(found)
+
+
+def prewarm():
+    """Load the Citoid type map and citation TemplateData into the caches"""
+    session = httpclient.get_session("citeinspector")
+    try:
+        template_type_map, supported_templates = get_citoid_template_types(session)
+        fill_templatedata_cache(template_type_map.values(), session)
+    except Exception as err:
+        logging.warning(f"Unable to prewarm citeinspector caches: {err}")
+
+
+def locate_templates(code, wikicode_index, cite):
+    """Find the citation template(s) a cite from find_refs() came from"""
+    locators = cite.get("locators")
+    if locators:
+        templates = []
+        for locator in locators:
+            try:
+                kind, i = locator
+                if kind == "ref":
+                    node, template = wikicode_index.refs[i]
+                else:
+                    node = template = wikicode_index.top_templates[i]
+            except (IndexError, TypeError, ValueError):
+                break
+            if template is None or str(node) != cite["wikitext"]:
+                break
+            templates.append(template)
+        else:
+            return templates
+
+    # Output from before locators existed, or locators that don't match.
+    # Fall back to searching the whole page.
+    templates = []
+    for obj in code.filter(matches=cite["wikitext"]):
+        if obj != cite["wikitext"]:
+            continue
+        elif type(obj) == mwparserfromhell.nodes.tag.Tag:
+            templates.append(obj.contents.filter_templates()[0])
+        elif type(obj) == mwparserfromhell.nodes.template.Template:
+            templates.append(obj)
+    return templates
 
 
 @bp.route("/", methods=["GET"])
@@ -442,6 +784,9 @@ def form():
 def output():
     rawinput = flask.request.form["page_url"]
     url, title = get_page_url(rawinput)
+    if flask.request.form.get("stream"):
+        return stream_output(url, title)
+
     output, wikitext, meta = citeinspector(url)
     meta["url"] = url
     meta["title"] = title
@@ -453,12 +798,83 @@ def output():
         return flask.render_template("citeinspector-none.html", meta=meta), 404
 
 
+def stream_output(url, title):
+    """Send each citation to the browser as soon as it has been matched"""
+    meta = {"url": url, "title": title}
+    wikitext, cites = iter_citeinspector(url, meta, stream=True)
+    output = {}
+
+    def collect():
+        for name, citedata in cites:
+            output[name] = citedata
+            yield name, citedata
+
+    response = flask.Response(
+        flask.stream_with_context(
+            flask.stream_template(
+                "citeinspector-stream.html",
+                cites=collect(),
+                d=output,
+                wikitext=wikitext,
+                meta=meta,
+            )
+        )
+    )
+    # Ask the front proxy not to buffer the response
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@jobs.handler("citeinspector")
+def citeinspector_job(payload):
+    output, wikitext, meta = citeinspector(payload["url"])
+    meta["url"] = payload["url"]
+    meta["title"] = payload["title"]
+    return {"output": output, "wikitext": wikitext, "meta": meta}
+
+
+@bp.route("/jobs", methods=["POST"])
+def submit_job():
+    """Queue a page to be inspected in the background"""
+    try:
+        url, title = get_page_url(flask.request.form["page_url"])
+    except ValueError:
+        return flask.jsonify({"error": "Invalid URL"}), 400
+    job_id = jobs.submit("citeinspector", {"url": url, "title": title}, dedup_key=url)
+    return jobs.submitted_response(job_id)
+
+
+@bp.route("/jobs/<job_id>")
+def job_output(job_id):
+    """Show the result of a background job, or its status if it isn't done"""
+    job = jobs.queue.get(job_id)
+    if job is None or job["kind"] != "citeinspector":
+        flask.abort(404)
+    if job["status"] != "done":
+        return jobs.pending_response(job)
+    result = job["result"]
+    if len(result["output"]):
+        return flask.render_template(
+            "citeinspector-diff.html",
+            d=result["output"],
+            wikitext=result["wikitext"],
+            meta=result["meta"],
+        )
+    else:
+        return (
+            flask.render_template("citeinspector-none.html", meta=result["meta"]),
+            404,
+        )
+
+
 @bp.route("/concat", methods=["POST"])
 def concat():
     data = flask.json.loads(flask.request.form["data"])
     meta = flask.json.loads(flask.request.form["meta"])
     wikitext = flask.request.form["wikitext"]
-    code = mwparserfromhell.parse(wikitext)
+    code = parsing.parse(
+        wikitext, page=meta["url"], revision=meta["edit_time"], mutable=True
+    )
     changes = {}
     for key, value in flask.request.form.items():
         if key in ["wikitext", "data", "meta"] or value == "":
@@ -471,16 +887,9 @@ def concat():
                 changes[cite_id] = {}
             changes[cite_id][para] = value
 
+    wikicode_index = parsing.index(code)
     for cite_id, cite_data in changes.items():
-        cite_obj = code.filter(matches=data[cite_id]["wikitext"])
-        for obj in cite_obj:
-            if obj != data[cite_id]["wikitext"]:
-                continue
-            elif type(obj) == mwparserfromhell.nodes.tag.Tag:
-                cite_template = obj.contents.filter_templates()[0]
-            elif type(obj) == mwparserfromhell.nodes.template.Template:
-                cite_template = obj
-
+        for cite_template in locate_templates(code, wikicode_index, data[cite_id]):
             for para, value in cite_data.items():
                 cite_template.add(para, value)
 
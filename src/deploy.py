@@ -8,7 +8,8 @@ import logging
 import subprocess
 
 import flask
-import requests
+
+from . import httpclient
 
 bp = flask.Blueprint("deploy", __name__, url_prefix="/deploy")
 
@@ -47,7 +48,8 @@ def restart_webservice():
 def update_status(url, status, auth):
     payload = {"state": status}
     headers = {"Accept": "application/vnd.github.flash-preview+json"}
-    response = requests.post(url, auth=auth, json=payload, headers=headers)
+    session = httpclient.get_session("deploy")
+    response = session.post(url, auth=auth, json=payload, headers=headers)
     logging.debug(response.text)
     return response.status_code == 201
 
@@ -4,44 +4,129 @@
 # Copyright 2020 AntiCompositeNumber
 
 import flask
+import concurrent.futures
 import datetime
-import requests
 import re
 import logging
 import json
 import itertools
+import os
+import threading
+import time
+import hashlib
+import click
 import pywikibot
 from pywikibot.data.api import Request
 import mwparserfromhell as mwph
-from typing import Set, NamedTuple, Iterator, Dict, Union, List, cast, Sequence
+from typing import (
+    Set,
+    Iterator,
+    Dict,
+    Union,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    cast,
+    Sequence,
+)
+
+from . import cache, dsdata, httpclient, retry
+from .dsdata import (
+    AlertColumns,
+    AlertFilter,
+    AlertStore,
+    DsAlert,
+    TopicIndex,
+    is_closed,
+    month_before,
+    time_shards,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 bp = flask.Blueprint("dsalerts", __name__, url_prefix="/dsalerts")
 site = pywikibot.Site('en', 'wikipedia')
-session = requests.Session()
-session.headers.update(
-    {
-        "User-Agent": "anticompositetools/dsalerts "
-        "(https://anticompositetools.toolforge.org/dsalerts ; "
-        "tools.anticompositetools@tools.wmflabs.org) python-requests/"
-        + requests.__version__
-    }
-)
+session = httpclient.get_session("dsalerts")
 Topics = Dict[str, Dict[str, str]]
 Cases = Dict[str, Dict[str, Union[str, List[str]]]]
+# Long ranges are fetched as independent shards of this length, in parallel
+SHARD_LENGTH = datetime.timedelta(days=7)
+FETCH_MAX_WORKERS = 4
+# Finished data for recent queries. Ranges that ended more than SYNC_LAG ago
+# can't change, so they are kept much longer than ranges that include today.
+response_cache = cache.LRUCache(maxsize=256)
+RESPONSE_TTL_CLOSED = 7 * 24 * 60 * 60
+RESPONSE_TTL_OPEN = 5 * 60
+# Local copy of alerts, set up from the dsalerts_store_path config key.
+# Set it to an empty string to always query the API directly.
+store: Optional[AlertStore] = None
+# Abuse log entries can show up late (replica lag), so the store only marks
+# a range as fetched once it is at least this old.
+SYNC_LAG = datetime.timedelta(minutes=5)
+# Most API requests get_shard_hits() makes for one range
+MAX_QUERIES = 100
+
+
+class FetchLimitError(Exception):
+    """A range had more abuse log hits than get_shard_hits() will fetch"""
+
+
+@bp.record_once
+def setup(state):
+    global store, RESPONSE_TTL_CLOSED, RESPONSE_TTL_OPEN
+    default_path = os.path.join(os.path.dirname(__file__), "dsalerts.sqlite")
+    path = state.app.config.get("dsalerts_store_path", default_path)
+    if path:
+        store = AlertStore(path)
+    DsTopics.cache_path = state.app.config.get(
+        "dsalerts_topics_path", os.path.join(os.path.dirname(__file__), "dstopics.json")
+    )
+    response_cache.maxsize = state.app.config.get("dsalerts_cache_size", 256)
+    RESPONSE_TTL_CLOSED = state.app.config.get(
+        "dsalerts_cache_ttl", RESPONSE_TTL_CLOSED
+    )
+    RESPONSE_TTL_OPEN = state.app.config.get(
+        "dsalerts_cache_ttl_today", RESPONSE_TTL_OPEN
+    )
 
 
-class DsAlert(NamedTuple):
-    timestamp: datetime.datetime
-    alerted_user: str
-    sending_user: str
-    topic_code: str
+def get_ds_alert_hits(
+    start_date: datetime.datetime,
+    end_date: datetime.datetime,
+    alert_filter: Optional[AlertFilter] = None,
+) -> Iterator[DsAlert]:
+    """Alerts from the abuse log, oldest first.
+
+    With alert_filter, hits that don't match are skipped before they are
+    parsed, and a single sending user is passed on to the API.
+    """
+    shards = time_shards(start_date, end_date, SHARD_LENGTH)
+    if len(shards) == 1:
+        yield from get_shard_hits(start_date, end_date, alert_filter)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(FETCH_MAX_WORKERS, len(shards))
+    ) as executor:
+        futures = [
+            executor.submit(
+                lambda shard: list(get_shard_hits(*shard, alert_filter)), shard
+            )
+            for shard in shards
+        ]
+        # Shards don't overlap and each comes back oldest first, so yielding
+        # them in order is a merge by timestamp. Earlier shards can be used
+        # while later ones are still being fetched.
+        for future in futures:
+            yield from future.result()
 
 
-def get_ds_alert_hits(
-    start_date: datetime.datetime, end_date: datetime.datetime
+def get_shard_hits(
+    start_date: datetime.datetime,
+    end_date: datetime.datetime,
+    alert_filter: Optional[AlertFilter] = None,
 ) -> Iterator[DsAlert]:
     # url = "https://en.wikipedia.org/w/api.php"
     params = {
@@ -54,20 +139,18 @@ def get_ds_alert_hits(
         "afldir": "newer",
         "aflfilter": 602,
         "afllimit": "max",
-        "aflprop": "user|title|result|timestamp|details|revid",
+        "aflprop": "ids|user|title|result|timestamp|details|revid",
         "continue": "",
     }
-    for i in range(100):
+    if alert_filter and alert_filter.single_sender():
+        params["afluser"] = alert_filter.single_sender()
+    for i in range(MAX_QUERIES):
         logger.debug(i)
-        # res = session.get(url, params=params)
-        # res.raise_for_status()
-        # raw_data = res.json()
-        req = Request(site=site, parameters=params, use_get=True)
-        raw_data = req.submit()
+        raw_data = submit_request(params)
         # breakpoint()
         for hit in raw_data["query"]["abuselog"]:
             if hit["result"] == "tag":
-                for alert in parse_alert_data(hit):
+                for alert in parse_alert_data(hit, alert_filter):
                     yield alert
 
         if raw_data.get("continue"):
@@ -76,47 +159,190 @@ def get_ds_alert_hits(
         else:
             break
     else:
-        # flask.abort(400)
-        logger.warning("Too many API queries!")
+        # Raised rather than returning part of the range, so the store
+        # doesn't mark the rest as fetched
+        raise FetchLimitError(
+            f"More than {MAX_QUERIES} API queries for {start_date} to {end_date}"
+        )
+
+
+# pywikibot's own retries are turned off, so these come straight back to us
+_transient_errors = (
+    pywikibot.exceptions.ServerError,
+    getattr(pywikibot.exceptions, "ApiTimeoutError", None)
+    or pywikibot.exceptions.TimeoutError,
+)
+
+
+def submit_request(params: dict) -> dict:
+    """Submit an API query, retrying with retry.default's backoff.
+
+    This goes through pywikibot rather than the shared session because the
+    abuse log only shows hit details to the bot's logged-in account.
+    """
+    attempts = retry.default.start()
+    while True:
+        req = Request(site=site, parameters=params, use_get=True, max_retries=0)
+        try:
+            return req.submit()
+        except _transient_errors:
+            if not attempts.sleep():
+                raise
+
+
+def get_alert_columns(
+    start_date: datetime.datetime,
+    end_date: datetime.datetime,
+    alert_filter: Optional[AlertFilter] = None,
+) -> AlertColumns:
+    """Get matching alerts from the store, fetching anything it doesn't have yet"""
+    if store is None:
+        return AlertColumns.from_alerts(
+            get_ds_alert_hits(start_date, end_date, alert_filter)
+        )
+    sync_store(start_date, end_date)
+    return store.columns(start_date, end_date, alert_filter)
+
+
+def synced_until() -> datetime.datetime:
+    return dsdata.synced_until(datetime.datetime.utcnow(), SYNC_LAG)
+
+
+def sync_store(start_date: datetime.datetime, end_date: datetime.datetime) -> bool:
+    """Fetch whatever the store is missing up to end_date or synced_until().
+
+    Returns True if the store now has every alert up to end_date.
+    """
+    # The store has to have every alert, so it can't use the filter to fetch
+    sync_end = min(end_date, synced_until())
+    if start_date > sync_end:
+        return False
+    synced = cast(AlertStore, store).sync(get_ds_alert_hits, start_date, sync_end)
+    return synced and sync_end == end_date
+
+
+@bp.cli.command("sync")
+@click.option("--days", type=int, default=30, help="Days to fetch into an empty store.")
+def sync_command(days):
+    """Fetch new alerts from the abuse log into the store."""
+    if store is None:
+        raise click.ClickException("dsalerts_store_path is not set")
+    now = synced_until()
+    if store.newest() is None:
+        store.sync(get_ds_alert_hits, now - datetime.timedelta(days=days), now)
+    else:
+        store.sync_forward(get_ds_alert_hits, now)
 
 
 class DsTopics:
-    _topics = None
-    _cases = None
-    _aliases = None
-    last_update = None
+    """Topics and cases from Template:Ds/topics and Template:Gs/topics.
+
+    The data is kept as one immutable TopicIndex, replaced in a single
+    assignment, so readers always see a consistent snapshot. Once it is more
+    than max_age seconds old, it is refreshed in a background thread while
+    callers keep getting the old copy. Only one refresh runs at a time, and
+    after a failed one the next waits at least retry_after seconds. Each
+    refresh is saved to cache_path (set from the dsalerts_topics_path config
+    key), so a restarted worker starts with the last copy instead of waiting
+    on the wiki.
+    """
+
+    _index: Optional[TopicIndex] = None
+    max_age = 30 * 60
+    retry_after = 5 * 60
+    cache_path: Optional[str] = None
+    _lock = threading.Lock()
+    _refreshing = False
+    _last_attempt = 0.0
 
     @classmethod
-    def topics(cls) -> Topics:
-        if not cls._topics or (
-            datetime.datetime.now() - cls.last_update > datetime.timedelta(minutes=30)
+    def index(cls) -> TopicIndex:
+        index = cls._index
+        if index is None:
+            with cls._lock:
+                # Nothing to serve yet, so every caller waits for one fetch
+                if cls._index is None and not cls.load():
+                    cls.get_data()
+            index = cast(TopicIndex, cls._index)
+        elif (
+            time.time() - index.updated > cls.max_age
+            and time.time() - cls._last_attempt > cls.retry_after
         ):
+            with cls._lock:
+                # Another thread may have started one since the check above
+                if cls._refreshing or time.time() - cls._last_attempt <= (
+                    cls.retry_after
+                ):
+                    return index
+                cls._refreshing = True
+                cls._last_attempt = time.time()
+            threading.Thread(
+                target=cls._refresh, name="dstopics-refresh", daemon=True
+            ).start()
+        return index
+
+    @classmethod
+    def _refresh(cls) -> None:
+        try:
             cls.get_data()
-        return cast(Topics, cls._topics)
+        except Exception:
+            logger.exception("Unable to refresh DS topics, keeping the old copy")
+        finally:
+            cls._refreshing = False
+
+    @classmethod
+    def topics(cls) -> Topics:
+        return cls.index().topics
 
     @classmethod
     def cases(cls) -> Cases:
-        if not cls._cases or (
-            datetime.datetime.now() - cls.last_update > datetime.timedelta(minutes=30)
-        ):
-            cls.get_data()
-        return cast(Cases, cls._cases)
+        return cls.index().cases
 
     @classmethod
     def aliases(cls) -> Dict[str, str]:
-        if not cls._aliases or (
-            datetime.datetime.now() - cls.last_update > datetime.timedelta(minutes=30)
-        ):
-            cls.get_data()
-        return cast(Dict[str, str], cls._aliases)
+        return cls.index().aliases
+
+    @classmethod
+    def load(cls) -> bool:
+        """Load the last saved copy, returning True if there was one"""
+        if not cls.cache_path:
+            return False
+        try:
+            with open(cls.cache_path) as f:
+                data = json.load(f)
+            cls._index = TopicIndex.build(
+                data["topics"], data["cases"], data["aliases"], data["time"]
+            )
+        except (OSError, ValueError, KeyError):
+            return False
+        return True
+
+    @classmethod
+    def save(cls) -> None:
+        index = cls._index
+        if not cls.cache_path or index is None:
+            return
+        data = dict(
+            topics=index.topics,
+            cases=index.cases,
+            aliases=index.aliases,
+            time=index.updated,
+        )
+        # Write a temporary file and rename it, so readers never see half
+        tmp_path = f"{cls.cache_path}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, cls.cache_path)
+        except OSError:
+            logger.exception("Unable to save DS topics")
 
     @classmethod
     def get_data(cls):
         topics: Topics = {}
         for page in ["Template:Ds/topics", "Template:Gs/topics"]:
             url = f"https://en.wikipedia.org/w/index.php?title={page}&action=raw"
-            res = session.get(url)
-            res.raise_for_status()
+            res = retry.call(lambda: session.get(url))
             key = ""
             keys = {"sanctions scope": "scope", "sanctions link": "page"}
             for line in res.text.split("\n"):
@@ -153,95 +379,98 @@ class DsTopics:
             for code in codes:
                 aliases[code] = codes[0]
 
-        cls._topics = topics
-        cls._cases = cases
-        cls._aliases = aliases
-        cls.last_update = datetime.datetime.now()
+        cls._index = TopicIndex.build(topics, cases, aliases, time.time())
+        cls.save()
 
 
-def normalize_topic(topic: str) -> str:
-    return DsTopics.aliases().get(topic.lower(), "")
+def normalize_topic(topic: str, index: Optional[TopicIndex] = None) -> str:
+    """Canonical code for a topic code, alias or case name.
 
+    Pass the index from DsTopics.index() when normalizing many topics.
+    """
+    if index is None:
+        index = DsTopics.index()
+    return index.normalize(topic)
 
-def parse_alert_data(hit: dict) -> List[DsAlert]:
-    regex = (
-        r"\{\{\s*subst:(?:template:)?(?:ds[ /]alert|sblp|blpse|alert|arbcom-alert|"
-        r"arbcom–alert|uw-sanctions|T:DSA|uw-alert|discretionary[ _]sanctions[ /]alert"
-        r"|alerting|gs/alert|uw-probation).*\|.*\}\}"
-    )
-    alerts = []
+
+# Names of the templates used to give DS alerts, with an optional namespace
+_alert_names = (
+    r"\{\{\s*subst:(?:template:)?(?:ds[ /]alert|sblp|blpse|alert|arbcom-alert|"
+    r"arbcom–alert|uw-sanctions|T:DSA|uw-alert|discretionary[ _]sanctions[ /]alert"
+    r"|alerting|gs/alert|uw-probation)"
+)
+# Every template matching _alert_template contains a match for _alert_start,
+# so added text without one can't contain an alert and isn't parsed at all.
+_alert_start = re.compile(_alert_names, flags=re.IGNORECASE)
+_alert_template = re.compile(
+    _alert_names + r".*\|.*\}\}", flags=re.IGNORECASE | re.DOTALL | re.UNICODE
+)
+
+
+def _is_alert_template(template) -> bool:
+    return _alert_template.search(str(template)) is not None
+
+
+def parse_alert_data(
+    hit: dict, alert_filter: Optional[AlertFilter] = None
+) -> List[DsAlert]:
+    alerts: List[DsAlert] = []
+    alerted_user = hit["details"]["page_title"]
+    if alert_filter and not alert_filter.match_users(alerted_user, hit["user"]):
+        return alerts
     text = "\n".join(hit["details"]["added_lines"])
+    if not _alert_start.search(text):
+        return alerts
     wikicode = mwph.parse(text)
-    for template in wikicode.ifilter_templates(matches=regex):
+    index = DsTopics.index()
+    timestamp = datetime.datetime.fromisoformat(hit["timestamp"][:-1])
+    templates = wikicode.ifilter_templates(matches=_is_alert_template)
+    for position, template in enumerate(templates):
         for param in ["1", "t", "topic"]:
             if template.has(param):
                 topic_code = normalize_topic(
-                    str(template.get(param)).rpartition("=")[2]
+                    str(template.get(param)).rpartition("=")[2], index
                 )
                 break
         else:
             continue
         if not topic_code or topic_code == "topic code":
             continue
+        if alert_filter and not alert_filter.match_topic(topic_code):
+            continue
         alerts.append(
             DsAlert(
-                timestamp=datetime.datetime.fromisoformat(hit["timestamp"][:-1]),
-                alerted_user=hit["details"]["page_title"],
+                timestamp=timestamp,
+                alerted_user=alerted_user,
                 sending_user=hit["user"],
                 topic_code=topic_code,
+                log_id=hit["id"],
+                position=position,
             )
         )
     return alerts
 
 
-def filter_alert(alert: DsAlert, filters: Dict[str, Set[str]]):
-    for key, values in filters.items():
-        if getattr(alert, key) not in values:
-            return False
-    else:
-        return True
-
-
 def timeseries_data(
     start_date: datetime.datetime,
     resolution: str,
     end_date: datetime.datetime = datetime.datetime.utcnow(),
     filters: Dict[str, Set[str]] = {},
 ):
-    replace = {
-        "second": {},
-        "day": {},
-        "month": {"day": 1},
-        "year": {"day": 1, "month": 1},
-    }
-    alerts = [
-        alert
-        for alert in get_ds_alert_hits(start_date, end_date)
-        if filter_alert(alert, filters)
-    ]
-    data = {}
-    for alert in alerts:
-        timestamp = alert.timestamp
-        if resolution != "second":
-            timestamp = timestamp.date()
-        timestamp = timestamp.replace(**replace[resolution]).isoformat()
-        data[timestamp][alert.topic_code] = (
-            data.setdefault(timestamp, {}).get(alert.topic_code, 0) + 1
-        )
-    totals = {}
-    for date, counts in data.items():
-        date_total = 0
-        for topic, count in counts.items():
-            date_total += count
-            totals[topic] = totals.get(topic, 0) + count
-        counts["Total"] = date_total
-    totals["Total"] = sum(totals.values())
-    data["Total"] = totals
-    return data
+    alert_filter = AlertFilter.compile(filters)
+    if store is not None and store.can_rollup(
+        start_date, end_date, resolution, alert_filter
+    ):
+        sync_store(start_date, end_date)
+        return store.rollup_timeseries(start_date, end_date, resolution, alert_filter)
+    columns = get_alert_columns(start_date, end_date, alert_filter)
+    return columns.timeseries(resolution)
 
 
 @bp.route("/api/topics/<datatype>")
 def api_topics(datatype):
+    if datatype not in ("topics", "cases", "aliases"):
+        flask.abort(404)
     data = getattr(DsTopics, datatype)
     return flask.jsonify(data())
 
@@ -252,39 +481,102 @@ def pipe_args(arglist: Sequence[str]) -> Iterator[str]:
             yield arg.strip()
 
 
-def get_data(args):
-    now = datetime.datetime.utcnow()
-    if args.get("start_date"):
-        start_date = datetime.datetime.fromisoformat(args["start_date"])
-    else:
-        start_date = now.replace(month=now.month - 1)
-    if args.get("end_date"):
-        end_date = datetime.datetime.fromisoformat(args["end_date"]).replace(
-            hour=23, minute=59, second=59
-        )
+class DataQuery(NamedTuple):
+    """Canonical form of the arguments to the data views, used as a cache key"""
 
-    filters = {}
-    if args.get("topic", "all") != "all":
-        filters["topic_code"] = set(
-            normalize_topic(topic) for topic in pipe_args(args.getlist("topic"))
+    start_date: datetime.datetime
+    end_date: datetime.datetime
+    resolution: str
+    filters: Tuple[Tuple[str, Tuple[str, ...]], ...]
+
+    @classmethod
+    def from_args(cls, args, now: Optional[datetime.datetime] = None) -> "DataQuery":
+        if now is None:
+            now = datetime.datetime.utcnow()
+        if args.get("start_date"):
+            start_date = datetime.datetime.fromisoformat(args["start_date"])
+        else:
+            # Start at midnight, so the default query is the same all day
+            start_date = datetime.datetime.combine(
+                month_before(now).date(), datetime.time()
+            )
+        if args.get("end_date"):
+            end_date = datetime.datetime.fromisoformat(args["end_date"]).replace(
+                hour=23, minute=59, second=59
+            )
+        else:
+            end_date = now.replace(hour=23, minute=59, second=59, microsecond=0)
+
+        filters = {}
+        if args.get("topic", "all") != "all":
+            index = DsTopics.index()
+            filters["topic_code"] = set(
+                normalize_topic(topic, index)
+                for topic in pipe_args(args.getlist("topic"))
+            )
+        if args.get("sending_user"):
+            filters["sending_user"] = set(pipe_args(args.getlist("sending_user")))
+        if args.get("alerted_user"):
+            filters["alerted_user"] = set(pipe_args(args.getlist("alerted_user")))
+
+        return cls(
+            start_date=start_date,
+            end_date=end_date,
+            resolution=args["resolution"],
+            filters=tuple(
+                (key, tuple(sorted(values))) for key, values in sorted(filters.items())
+            ),
         )
-    if args.get("sending_user"):
-        filters["sending_user"] = set(pipe_args(args.getlist("sending_user")))
-    if args.get("alerted_user"):
-        filters["alerted_user"] = set(pipe_args(args.getlist("alerted_user")))
+
+
+class CachedData(NamedTuple):
+    data: dict
+    etag: str
+    expires: float
+
+
+def get_cached_data(query: DataQuery) -> CachedData:
+    cached = response_cache.get(query)
+    if cached is not None:
+        return cached
 
     data = timeseries_data(
-        start_date=start_date,
-        resolution=args["resolution"],
-        end_date=end_date,
-        filters=filters,
+        start_date=query.start_date,
+        resolution=query.resolution,
+        end_date=query.end_date,
+        filters={key: set(values) for key, values in query.filters},
+    )
+    # The store may not have the whole range yet, if another request was
+    # still fetching part of it. Then it's only kept as long as an open one.
+    complete = store is None or not store.gaps(
+        dsdata.to_epoch(query.start_date), dsdata.to_epoch(query.end_date)
     )
-    return data
+    if complete and is_closed(query.end_date, datetime.datetime.utcnow(), SYNC_LAG):
+        ttl = RESPONSE_TTL_CLOSED
+    else:
+        ttl = RESPONSE_TTL_OPEN
+    etag = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    cached = CachedData(data, etag, time.time() + ttl)
+    response_cache.set(query, cached, ttl=ttl)
+    return cached
+
+
+def get_data(args):
+    return get_cached_data(DataQuery.from_args(args)).data
+
+
+def cached_response(response: flask.Response, cached: CachedData, etag: str):
+    """Let browsers and proxies reuse a response until its data expires"""
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max(0, int(cached.expires - time.time()))
+    return response.make_conditional(flask.request)
 
 
 @bp.route("/api/data")
 def api_data():
-    return flask.jsonify(get_data(flask.request.args))
+    cached = get_cached_data(DataQuery.from_args(flask.request.args))
+    return cached_response(flask.jsonify(cached.data), cached, cached.etag)
 
 
 def colors():
@@ -311,7 +603,8 @@ def colors():
 
 @bp.route("/data")
 def show_data():
-    data = get_data(flask.request.args)
+    cached = get_cached_data(DataQuery.from_args(flask.request.args))
+    data = cached.data
     topics = set(itertools.chain(*(val.keys() for val in data.values())))
     logger.debug(topics)
     chart = [
@@ -329,15 +622,20 @@ def show_data():
         for (case, cdata), color in zip(DsTopics.cases().items(), colors())
         if cdata["codes"][0] in topics
     ]
-    return flask.render_template(
-        "dsalerts_data.html", d=data, topics=DsTopics.topics(), chart=json.dumps(chart)
+    index = DsTopics.index()
+    response = flask.make_response(
+        flask.render_template(
+            "dsalerts_data.html", d=data, topics=index.topics, chart=json.dumps(chart)
+        )
     )
+    # The page also shows topic names, so it changes when the topics do
+    return cached_response(response, cached, f"{cached.etag}-{index.updated}")
 
 
 @bp.route("/")
 def form():
     now = datetime.datetime.utcnow()
-    default_start = now.replace(month=now.month - 1)
+    default_start = month_before(now)
     return flask.render_template(
         "dsalerts_form.html",
         cases=DsTopics.cases(),
@@ -0,0 +1,605 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Local storage for dsalerts.
+
+AlertStore keeps every DS alert found in the abuse log in a SQLite database,
+along with the time ranges that have been fetched completely. Queries only
+need the API for the parts of their range the store doesn't cover yet, which
+is usually just the time since the last sync. It also keeps daily counts by
+topic and sending user, updated as alerts are added, which whole-day queries
+can be answered from without reading individual alerts.
+
+AlertColumns holds a set of alerts as arrays of integers, with topics and
+user names interned, and counts them by time period for the dsalerts charts.
+
+AlertFilter is the compiled form of the filters from a dsalerts query. It can
+be checked against an abuse-log hit before the hit is parsed, and turned into
+a WHERE clause for the store.
+
+TopicIndex is an immutable snapshot of the DS topics, with every spelling of
+a topic that normalize_topic() accepts mapped to a small integer id.
+
+Timestamps are stored as UTC epoch seconds; datetimes passed in and out are
+naive UTC, like the rest of dsalerts.
+"""
+
+import calendar
+import collections
+import datetime
+import functools
+import re
+import sqlite3
+import sys
+import threading
+import types
+from array import array
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+
+class DsAlert(NamedTuple):
+    timestamp: datetime.datetime
+    alerted_user: str
+    sending_user: str
+    topic_code: str
+    # Abuse log id of the edit, and which of the alerts added by that edit
+    # this is, so separate alerts with the same details are kept apart
+    log_id: int = 0
+    position: int = 0
+
+
+class AlertFilter(NamedTuple):
+    """Allowed values for each DsAlert field, or None to allow any"""
+
+    alerted_user: Optional[FrozenSet[str]] = None
+    sending_user: Optional[FrozenSet[str]] = None
+    topic_code: Optional[FrozenSet[str]] = None
+
+    @classmethod
+    def compile(cls, filters: Dict[str, Set[str]]) -> Optional["AlertFilter"]:
+        """Compile a dict of field name to allowed values, None if it's empty"""
+        if not filters:
+            return None
+        return cls(**{key: frozenset(values) for key, values in filters.items()})
+
+    def match_users(self, alerted_user: str, sending_user: str) -> bool:
+        return (self.alerted_user is None or alerted_user in self.alerted_user) and (
+            self.sending_user is None or sending_user in self.sending_user
+        )
+
+    def match_topic(self, topic_code: str) -> bool:
+        return self.topic_code is None or topic_code in self.topic_code
+
+    def __call__(self, alert: DsAlert) -> bool:
+        return self.match_users(
+            alert.alerted_user, alert.sending_user
+        ) and self.match_topic(alert.topic_code)
+
+    def single_sender(self) -> Optional[str]:
+        """The only allowed sending user, if there is exactly one"""
+        if self.sending_user is not None and len(self.sending_user) == 1:
+            return next(iter(self.sending_user))
+        return None
+
+    def where(self) -> Tuple[str, List[str]]:
+        """SQL condition and parameters selecting the matching alerts"""
+        clauses = []
+        params: List[str] = []
+        for key, values in self._asdict().items():
+            if values is not None:
+                clauses.append(f"{key} IN ({', '.join('?' * len(values))})")
+                params.extend(sorted(values))
+        return " AND ".join(clauses) or "1", params
+
+
+def topic_key(name: str) -> str:
+    """Loose form of a topic code or case name: lowercase letters and digits"""
+    return re.sub(r"[\W_]+", "", name.lower())
+
+
+class TopicIndex(NamedTuple):
+    topics: Dict[str, Dict[str, str]]
+    cases: Dict[str, Dict[str, Any]]
+    aliases: Dict[str, str]
+    updated: float
+    # Canonical code of each topic, indexed by topic id
+    codes: Tuple[str, ...]
+    # Code, lowercase code, case name and topic_key() of each -> topic id
+    ids: Mapping[str, int]
+
+    @classmethod
+    def build(
+        cls,
+        topics: Dict[str, Dict[str, str]],
+        cases: Dict[str, Dict[str, Any]],
+        aliases: Dict[str, str],
+        updated: float,
+    ) -> "TopicIndex":
+        codes = tuple(sys.intern(case["codes"][0]) for case in cases.values())
+        ids: Dict[str, int] = {}
+        # Exact codes take priority over case names, and both over loose forms
+        for topic_id, case in enumerate(cases.values()):
+            for code in case["codes"]:
+                ids.setdefault(code, topic_id)
+                ids.setdefault(code.lower(), topic_id)
+        for topic_id, name in enumerate(cases):
+            ids.setdefault(name, topic_id)
+            ids.setdefault(name.lower(), topic_id)
+        for topic_id, (name, case) in enumerate(cases.items()):
+            for alias in [*case["codes"], name]:
+                ids.setdefault(topic_key(alias), topic_id)
+        ids.pop("", None)
+        return cls(topics, cases, aliases, updated, codes, types.MappingProxyType(ids))
+
+    def topic_id(self, topic: str) -> int:
+        """Id of the topic, or -1 if it isn't a known topic"""
+        topic_id = self.ids.get(topic)
+        if topic_id is None:
+            topic_id = self.ids.get(topic.lower())
+            if topic_id is None:
+                topic_id = self.ids.get(topic_key(topic), -1)
+        return topic_id
+
+    def normalize(self, topic: str) -> str:
+        """Canonical code for the topic, or an empty string if unknown"""
+        topic_id = self.topic_id(topic)
+        return self.codes[topic_id] if topic_id >= 0 else ""
+
+
+DAY = 24 * 60 * 60
+
+
+def to_epoch(date: datetime.datetime) -> int:
+    return calendar.timegm(date.utctimetuple())
+
+
+def from_epoch(timestamp: int) -> datetime.datetime:
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=timestamp)
+
+
+def month_before(date: datetime.datetime) -> datetime.datetime:
+    """The same day of the previous month, or its last day if that's shorter"""
+    year, month = (date.year, date.month - 1) if date.month > 1 else (date.year - 1, 12)
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
+
+
+def synced_until(now: datetime.datetime, lag: datetime.timedelta) -> datetime.datetime:
+    """How far the store should be synced: lag before now, to the minute.
+
+    Abuse log entries can show up late, so the last lag's worth isn't
+    treated as complete yet. Rounding means queries in the same minute
+    don't each fetch the few seconds since the last one.
+    """
+    return (now - lag).replace(second=0, microsecond=0)
+
+
+def is_closed(
+    end_date: datetime.datetime, now: datetime.datetime, lag: datetime.timedelta
+) -> bool:
+    """Whether a range ending at end_date can't get any more alerts"""
+    return end_date <= synced_until(now, lag)
+
+
+class AlertColumns:
+    """Alerts stored column by column.
+
+    Timestamps are epoch seconds, topics and users are indexes into
+    topic_names and user_names. Each alert takes 20 bytes instead of a
+    DsAlert with a datetime and three strings.
+    """
+
+    def __init__(self):
+        self.timestamps = array("q")
+        self.topics = array("i")
+        self.senders = array("i")
+        self.recipients = array("i")
+        self.topic_names: List[str] = []
+        self.user_names: List[str] = []
+        self._topic_ids: Dict[str, int] = {}
+        self._user_ids: Dict[str, int] = {}
+
+    @classmethod
+    def from_alerts(cls, alerts: Iterable[DsAlert]) -> "AlertColumns":
+        columns = cls()
+        for alert in alerts:
+            columns.append(
+                to_epoch(alert.timestamp),
+                alert.alerted_user,
+                alert.sending_user,
+                alert.topic_code,
+            )
+        return columns
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @staticmethod
+    def _intern(names: List[str], ids: Dict[str, int], name: str) -> int:
+        index = ids.get(name)
+        if index is None:
+            index = ids[name] = len(names)
+            names.append(name)
+        return index
+
+    def append(
+        self, timestamp: int, alerted_user: str, sending_user: str, topic_code: str
+    ) -> None:
+        self.timestamps.append(timestamp)
+        self.recipients.append(
+            self._intern(self.user_names, self._user_ids, alerted_user)
+        )
+        self.senders.append(self._intern(self.user_names, self._user_ids, sending_user))
+        self.topics.append(self._intern(self.topic_names, self._topic_ids, topic_code))
+
+    def select(self, filters: Dict[str, Set[str]]) -> Iterable[int]:
+        """Indexes of the alerts matching every filter"""
+        checks = []
+        for key, values in filters.items():
+            if key == "topic_code":
+                column, ids = self.topics, self._topic_ids
+            else:
+                column = self.senders if key == "sending_user" else self.recipients
+                ids = self._user_ids
+            wanted = {ids[value] for value in values if value in ids}
+            checks.append((column, wanted))
+        if not checks:
+            return range(len(self))
+        return [
+            i
+            for i in range(len(self))
+            if all(column[i] in wanted for column, wanted in checks)
+        ]
+
+    def timeseries(
+        self, resolution: str, filters: Optional[Dict[str, Set[str]]] = None
+    ) -> Dict[str, Dict[str, int]]:
+        """Count alerts by period and topic, with totals for each.
+
+        Periods are named by their first second (resolution "second") or day
+        (resolution "day", "month" or "year") in ISO format, and come in the
+        order they were first seen.
+        """
+        selected = self.select(filters or {})
+        unit, period_name = period_namer(resolution)
+
+        timestamps, topics = self.timestamps, self.topics
+        counts = collections.Counter(
+            zip(
+                (period_name(timestamps[i] // unit) for i in selected),
+                (topics[i] for i in selected),
+            )
+        )
+
+        data: Dict[str, Dict[str, int]] = {}
+        topic_names = self.topic_names
+        for (period, topic), count in counts.items():
+            data.setdefault(period, {})[topic_names[topic]] = count
+        return add_totals(data)
+
+
+def period_namer(resolution: str) -> Tuple[int, Callable[[int], str]]:
+    """Get the unit periods are counted in, in seconds, and a function that
+    names the period a unit (epoch time // unit) falls in.
+    """
+    unit = 1 if resolution == "second" else DAY
+
+    @functools.lru_cache(maxsize=None)
+    def period_name(period: int) -> str:
+        date = from_epoch(period * unit)
+        if resolution == "second":
+            return date.isoformat()
+        date = date.date()
+        if resolution == "month":
+            date = date.replace(day=1)
+        elif resolution == "year":
+            date = date.replace(day=1, month=1)
+        return date.isoformat()
+
+    return unit, period_name
+
+
+def add_totals(data: Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, int]]:
+    """Add a total to each period, and a "Total" period for the whole range"""
+    totals: Dict[str, int] = {}
+    for period_counts in data.values():
+        for topic, count in period_counts.items():
+            totals[topic] = totals.get(topic, 0) + count
+        period_counts["Total"] = sum(period_counts.values())
+    totals["Total"] = sum(totals.values())
+    data["Total"] = totals
+    return data
+
+
+def time_shards(
+    start_date: datetime.datetime,
+    end_date: datetime.datetime,
+    length: datetime.timedelta,
+) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+    """Split an inclusive range into consecutive ranges no longer than length.
+
+    Abuse log timestamps have one-second resolution, so each shard ends one
+    second before the next starts.
+    """
+    second = datetime.timedelta(seconds=1)
+    shards = []
+    shard_start = start_date
+    while True:
+        shard_end = shard_start + length - second
+        if shard_end >= end_date:
+            shards.append((shard_start, end_date))
+            return shards
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end + second
+
+
+Fetcher = Callable[[datetime.datetime, datetime.datetime], Iterable[DsAlert]]
+
+
+class AlertStore:
+    # Stores with an older user_version are emptied and fetched again
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # Only one thread fetches missing ranges at a time
+        self._sync_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            (version,) = self._conn.execute("PRAGMA user_version").fetchone()
+            if version < self.SCHEMA_VERSION:
+                # Version 0 kept one row per timestamp, users and topic, which
+                # merged separate alerts, so what it has can't be trusted
+                for table in ("alerts", "coverage", "rollup"):
+                    self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+                self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS alerts ("
+                "log_id INTEGER, position INTEGER, timestamp INTEGER, "
+                "alerted_user TEXT, sending_user TEXT, topic_code TEXT, "
+                "PRIMARY KEY (log_id, position))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS alerts_timestamp ON alerts (timestamp)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS coverage (start INTEGER, end INTEGER)"
+            )
+            # Alerts per day (epoch time // DAY), topic and sending user, and
+            # the time of the first, to keep topics in the order they were seen
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rollup ("
+                "day INTEGER, topic_code TEXT, sending_user TEXT, count INTEGER, "
+                "first INTEGER, PRIMARY KEY (day, topic_code, sending_user))"
+            )
+
+    def coverage(self) -> List[Tuple[int, int]]:
+        """Inclusive (start, end) epoch ranges that have been fetched"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT start, end FROM coverage ORDER BY start"
+            ).fetchall()
+
+    def gaps(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """Inclusive (start, end) epoch ranges within start-end not yet fetched"""
+        gaps = []
+        cur = start
+        for cov_start, cov_end in self.coverage():
+            if cov_end < cur:
+                continue
+            if cov_start > end:
+                break
+            if cov_start > cur:
+                gaps.append((cur, cov_start - 1))
+            cur = cov_end + 1
+            if cur > end:
+                break
+        if cur <= end:
+            gaps.append((cur, end))
+        return gaps
+
+    def newest(self) -> Optional[int]:
+        """End of the most recent fetched range"""
+        with self._lock:
+            (newest,) = self._conn.execute("SELECT MAX(end) FROM coverage").fetchone()
+        return newest
+
+    def add(self, alerts: Iterable[DsAlert], start: int, end: int) -> None:
+        """Store the alerts from a completely fetched range"""
+        rows = [
+            (
+                alert.log_id,
+                alert.position,
+                to_epoch(alert.timestamp),
+                alert.alerted_user,
+                alert.sending_user,
+                alert.topic_code,
+            )
+            for alert in alerts
+        ]
+        with self._lock, self._conn:
+            rollup: Dict[Tuple[int, str, str], List[int]] = {}
+            for row in rows:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO alerts VALUES (?, ?, ?, ?, ?, ?)", row
+                )
+                if not cursor.rowcount:
+                    # Already stored, and already counted
+                    continue
+                _, _, timestamp, alerted_user, sending_user, topic_code = row
+                key = (timestamp // DAY, topic_code, sending_user)
+                entry = rollup.get(key)
+                if entry is None:
+                    rollup[key] = [1, timestamp]
+                else:
+                    entry[0] += 1
+                    entry[1] = min(entry[1], timestamp)
+            self._conn.executemany(
+                "INSERT INTO rollup VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (day, topic_code, sending_user) DO UPDATE SET "
+                "count = count + excluded.count, first = MIN(first, excluded.first)",
+                [(*key, count, first) for key, (count, first) in rollup.items()],
+            )
+            # Merge the new range with any it overlaps or touches
+            new_start, new_end = self._conn.execute(
+                "SELECT MIN(MIN(start), ?), MAX(MAX(end), ?) FROM coverage "
+                "WHERE start <= ? AND end >= ?",
+                (start, end, end + 1, start - 1),
+            ).fetchone()
+            if new_start is None:
+                new_start, new_end = start, end
+            self._conn.execute(
+                "DELETE FROM coverage WHERE start <= ? AND end >= ?",
+                (end + 1, start - 1),
+            )
+            self._conn.execute(
+                "INSERT INTO coverage VALUES (?, ?)", (new_start, new_end)
+            )
+
+    def sync(
+        self,
+        fetch: Fetcher,
+        start_date: datetime.datetime,
+        end_date: datetime.datetime,
+    ) -> bool:
+        """Fetch and store every part of start_date-end_date not yet stored.
+
+        Only one thread fetches at a time. If the only part missing is newer
+        than anything stored and another thread is already fetching, this
+        returns straight away, leaving the caller a little behind instead of
+        waiting on the other fetch. Returns True if the whole range is stored.
+        """
+        start, end = to_epoch(start_date), to_epoch(end_date)
+        gaps = self.gaps(start, end)
+        if not gaps:
+            return True
+        newest = self.newest()
+        wait = newest is None or gaps[0][0] <= newest
+        if not self._sync_lock.acquire(blocking=wait):
+            return False
+        try:
+            for gap_start, gap_end in self.gaps(start, end):
+                alerts = fetch(from_epoch(gap_start), from_epoch(gap_end))
+                self.add(alerts, gap_start, gap_end)
+        finally:
+            self._sync_lock.release()
+        return True
+
+    def sync_forward(self, fetch: Fetcher, now: datetime.datetime) -> None:
+        """Extend the store from its newest fetched range up to now"""
+        newest = self.newest()
+        if newest is not None:
+            self.sync(fetch, from_epoch(newest + 1), now)
+
+    def columns(
+        self,
+        start_date: datetime.datetime,
+        end_date: datetime.datetime,
+        alert_filter: Optional[AlertFilter] = None,
+    ) -> AlertColumns:
+        """Stored alerts between start_date and end_date, as AlertColumns.
+
+        With alert_filter, only matching alerts are read from the database.
+        """
+        condition, params = (alert_filter or AlertFilter()).where()
+        columns = AlertColumns()
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT timestamp, alerted_user, sending_user, topic_code "
+                f"FROM alerts WHERE timestamp BETWEEN ? AND ? AND {condition} "
+                "ORDER BY timestamp, log_id, position",
+                (to_epoch(start_date), to_epoch(end_date), *params),
+            )
+            for row in cursor:
+                columns.append(*row)
+        return columns
+
+    @staticmethod
+    def can_rollup(
+        start_date: datetime.datetime,
+        end_date: datetime.datetime,
+        resolution: str,
+        alert_filter: Optional[AlertFilter] = None,
+    ) -> bool:
+        """Whether rollup_timeseries() can answer this query.
+
+        The range has to be whole days, periods have to be days or longer, and
+        the rollup doesn't know who was alerted.
+        """
+        return (
+            resolution in ("day", "month", "year")
+            and to_epoch(start_date) % DAY == 0
+            and (to_epoch(end_date) + 1) % DAY == 0
+            and (alert_filter is None or alert_filter.alerted_user is None)
+        )
+
+    def rollup_timeseries(
+        self,
+        start_date: datetime.datetime,
+        end_date: datetime.datetime,
+        resolution: str,
+        alert_filter: Optional[AlertFilter] = None,
+    ) -> Dict[str, Dict[str, int]]:
+        """Same as AlertColumns.timeseries() for the stored alerts in the
+        range, but counted from the daily rollup. Check can_rollup() first.
+        """
+        # Every resolution the rollup supports counts in days
+        _, period_name = period_namer(resolution)
+        condition, params = (alert_filter or AlertFilter()).where()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, topic_code, SUM(count), MIN(first) FROM rollup "
+                f"WHERE day BETWEEN ? AND ? AND {condition} "
+                "GROUP BY day, topic_code",
+                (to_epoch(start_date) // DAY, to_epoch(end_date) // DAY, *params),
+            ).fetchall()
+
+        counts: Dict[Tuple[str, str], List[int]] = {}
+        for day, topic_code, count, first in rows:
+            key = (period_name(day), topic_code)
+            entry = counts.get(key)
+            if entry is None:
+                counts[key] = [first, count]
+            else:
+                entry[0] = min(entry[0], first)
+                entry[1] += count
+
+        data: Dict[str, Dict[str, int]] = {}
+        # In the order each topic was first seen, like AlertColumns
+        for (period, topic_code), (first, count) in sorted(
+            counts.items(), key=lambda item: item[1][0]
+        ):
+            data.setdefault(period, {})[topic_code] = count
+        return add_totals(data)
+
+    def query(
+        self, start_date: datetime.datetime, end_date: datetime.datetime
+    ) -> Iterator[DsAlert]:
+        """Stored alerts between start_date and end_date, oldest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT timestamp, alerted_user, sending_user, topic_code, log_id, "
+                "position FROM alerts WHERE timestamp BETWEEN ? AND ? "
+                "ORDER BY timestamp, log_id, position",
+                (to_epoch(start_date), to_epoch(end_date)),
+            ).fetchall()
+        for timestamp, alerted_user, sending_user, topic_code, *key in rows:
+            yield DsAlert(
+                from_epoch(timestamp), alerted_user, sending_user, topic_code, *key
+            )
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Shared HTTP sessions for all of the tools.
+
+Every tool gets its own session (so it can send its own user agent), but all
+sessions share one connection pool adapter, so keep-alive connections to a
+host are reused across tools. Pool sizes and the default timeout come from
+these config.json keys:
+
+http_pool_connections -- number of hosts to keep pools for
+http_pool_maxsize -- connections kept per host
+http_timeout -- seconds, or [connect, read] seconds
+"""
+
+import threading
+import time
+import urllib.parse
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_TIMEOUT = (10, 60)
+
+
+def user_agent(tool: str) -> str:
+    return (
+        f"anticompositetools/{tool} "
+        f"(https://anticompositetools.toolforge.org/{tool}; "
+        "tools.anticompositetools@tools.wmflabs.org) python-requests/"
+        + requests.__version__
+    )
+
+
+class HostMetrics:
+    """Per-host request counts, errors and time spent waiting on responses"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, Dict[str, float]] = {}
+
+    def record(self, host: str, elapsed: float, error: bool = False) -> None:
+        with self._lock:
+            host_metrics = self._hosts.setdefault(
+                host, {"requests": 0, "errors": 0, "time": 0.0}
+            )
+            host_metrics["requests"] += 1
+            host_metrics["time"] += elapsed
+            if error:
+                host_metrics["errors"] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {host: dict(values) for host, values in self._hosts.items()}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._hosts.clear()
+
+
+metrics = HostMetrics()
+
+
+class ToolSession(requests.Session):
+    """requests.Session with a tool user agent and a default timeout"""
+
+    def __init__(self, tool: str, adapter: HTTPAdapter, timeout):
+        super().__init__()
+        self.tool = tool
+        self.timeout = timeout
+        self.headers["User-Agent"] = user_agent(tool)
+        self.mount_adapter(adapter)
+
+    def mount_adapter(self, adapter: HTTPAdapter) -> None:
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = urllib.parse.urlsplit(url).netloc
+        start = time.monotonic()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.record(host, time.monotonic() - start, error=True)
+            raise
+        metrics.record(host, time.monotonic() - start, response.status_code >= 400)
+        return response
+
+    def close(self) -> None:
+        # The adapter is shared with every other session, don't close it.
+        pass
+
+
+_lock = threading.Lock()
+_sessions: Dict[str, ToolSession] = {}
+_adapter = HTTPAdapter(
+    pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE
+)
+_timeout = DEFAULT_TIMEOUT
+
+
+def get_session(tool: str) -> ToolSession:
+    """Get the shared session for a tool, creating it if needed"""
+    with _lock:
+        session = _sessions.get(tool)
+        if session is None:
+            session = _sessions[tool] = ToolSession(tool, _adapter, _timeout)
+        return session
+
+
+def configure(config: Optional[dict] = None) -> None:
+    """Rebuild the connection pools from app config"""
+    global _adapter, _timeout
+    config = config or {}
+    timeout = config.get("http_timeout", DEFAULT_TIMEOUT)
+    if isinstance(timeout, list):
+        timeout = tuple(timeout)
+    adapter = HTTPAdapter(
+        pool_connections=config.get("http_pool_connections", DEFAULT_POOL_CONNECTIONS),
+        pool_maxsize=config.get("http_pool_maxsize", DEFAULT_POOL_MAXSIZE),
+    )
+    with _lock:
+        old_adapter = _adapter
+        _adapter, _timeout = adapter, timeout
+        for session in _sessions.values():
+            session.timeout = timeout
+            session.mount_adapter(adapter)
+    old_adapter.close()
@@ -3,60 +3,100 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 # Copyright 2021 AntiCompositeNumber
 
+import concurrent.futures
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import re
 import time
 import urllib.parse
 
+import click
 import flask
 import mwparserfromhell
 import requests
 from stdnum import isbn
 
+from . import httpclient, jobs, parsing, retry
+
 bp = flask.Blueprint("hyphenator", __name__, url_prefix="/hyphenator")
-flash = []
+# Titles per action=query request, the API limit for normal users
+BATCH_SIZE = 50
+# Distinct (raw ISBN, convert) pairs to remember the formatted form of
+ISBN_CACHE_SIZE = 65536
+_isbn_re = re.compile("isbn", re.IGNORECASE)
+# Markup that Wikicode.matches() strips from a template name before comparing
+_markup_re = re.compile(r"[<&{\[]")
+session = httpclient.get_session("hyphenator")
+logger = logging.getLogger(__name__)
+
+
+def flash(message, category="message"):
+    """Collect a message to show the user at the end of this request.
+
+    Messages are kept on flask.g, so each request (or background job) gets
+    its own list. Outside of an app context they are only logged.
+    """
+    if flask.has_app_context():
+        flask.g.setdefault("hyphenator_messages", []).append((message, category))
+    else:
+        logger.info(f"{category}: {message}")
+
+
+def get_messages():
+    """Messages collected by flash() during this request"""
+    if flask.has_app_context():
+        return flask.g.get("hyphenator_messages", [])
+    return []
 
 
 def get_wikitext(url):
     wikitext_url = url + "&action=raw"
 
-    headers = {
-        "user-agent": "anticompositetools/hyphenator "
-        "(https://anticompositetools.toolforge.org/hyphenator; "
-        "tools.anticompositetools@tools.wmflabs.org) python-requests/"
-        + requests.__version__
-    }
-
-    for i in range(1, 5):
-        try:
-            request = requests.get(wikitext_url, headers=headers)
-            request.raise_for_status()
-        except Exception:
-            if request.status_code == 404:
-                flash.append(("That page does not exist.", "danger"))
-                raise
-            elif i == 4:
-                flash.append(("Unable to retrieve wikitext.", "danger"))
-                raise
-            else:
-                time.sleep(5 * i)
-                continue
+    try:
+        request = retry.call(lambda: session.get(wikitext_url))
+    except requests.exceptions.HTTPError as err:
+        if err.response is not None and err.response.status_code == 404:
+            flash("That page does not exist.", "danger")
         else:
-            start_time = time.strftime("%Y%m%d%H%M%S", time.gmtime())
-            timestruct = time.strptime(
-                request.headers["Last-Modified"], "%a, %d %b %Y %H:%M:%S %Z"
-            )
-            edit_time = time.strftime("%Y%m%d%H%M%S", timestruct)
-            return (request.text, (edit_time, start_time))
+            flash("Unable to retrieve wikitext.", "danger")
+        raise
+    except Exception:
+        flash("Unable to retrieve wikitext.", "danger")
+        raise
+
+    start_time = time.strftime("%Y%m%d%H%M%S", time.gmtime())
+    timestruct = time.strptime(
+        request.headers["Last-Modified"], "%a, %d %b %Y %H:%M:%S %Z"
+    )
+    edit_time = time.strftime("%Y%m%d%H%M%S", timestruct)
+    return (request.text, (edit_time, start_time))
+
+
+def find_isbns(code, wikicode_index=None):
+    if wikicode_index is None:
+        wikicode_index = parsing.index(code)
 
+    # Parameter names are compared exactly, so if "isbn" isn't anywhere in
+    # the page, no parameter can hold one.
+    check_params = _isbn_re.search(str(code)) is not None
 
-def find_isbns(code):
-    for template in code.ifilter_templates():
-        if template.name.matches("ISBN") or template.name.matches("ISBNT"):
+    for template in wikicode_index.templates:
+        name = str(template.name)
+        # Only names that could match after stripping get the full comparison
+        if (_isbn_re.search(name) or _markup_re.search(name)) and (
+            template.name.matches("ISBN") or template.name.matches("ISBNT")
+        ):
             try:
                 raw_isbn = template.get("1").value.strip()
             except ValueError:
                 continue
             para = "1"
 
+        elif not check_params or not _has_isbn_param(template):
+            continue
         elif template.has("isbn", ignore_empty=True):
             raw_isbn = template.get("isbn").value.strip()
             para = "isbn"
@@ -69,6 +109,14 @@ def find_isbns(code):
         yield (template, raw_isbn, para)
 
 
+def _has_isbn_param(template):
+    """Cheap check for a parameter that template.has() might find"""
+    for param in template.params:
+        if _isbn_re.search(str(param.name)):
+            return True
+    return False
+
+
 def check_isbn(raw_isbn):
     """If the ISBN can be worked on, return True"""
     if len(raw_isbn) == 17 or not isbn.is_valid(raw_isbn):
@@ -77,6 +125,30 @@ def check_isbn(raw_isbn):
         return True
 
 
+@functools.lru_cache(maxsize=ISBN_CACHE_SIZE)
+def normalize_isbn(raw_isbn, convert=True):
+    """Return the hyphenated form of an ISBN, or None if it can't be worked on.
+
+    Validating and formatting both parse the ISBN against the range tables,
+    so the result is memoized. Always pass convert positionally, or the same
+    ISBN gets cached twice.
+    """
+    if not check_isbn(raw_isbn):
+        return None
+    return isbn.format(raw_isbn, convert=convert)
+
+
+def isbn_cache_stats():
+    info = normalize_isbn.cache_info()
+    lookups = info.hits + info.misses
+    return dict(
+        hits=info.hits,
+        misses=info.misses,
+        size=info.currsize,
+        hit_rate=info.hits / lookups if lookups else 0.0,
+    )
+
+
 def get_page_url(url):
     parsed = urllib.parse.urlparse(url)
     if parsed.path == "/w/index.php":
@@ -84,42 +156,225 @@ def get_page_url(url):
         if "oldid" not in query_params:
             title = query_params["title"][0]
         else:
-            flash.append(("Invalid URL", "danger"))
+            flash("Invalid URL", "danger")
             raise ValueError  # fix
     elif "/wiki/" in parsed.path:
         # Because some people expect invalid URLs to work anyway
         title = urllib.parse.quote(urllib.parse.unquote(parsed.path[6:]), safe=":/")
     else:
-        flash.append(("Invalid URL", "danger"))
+        flash("Invalid URL", "danger")
         raise ValueError  # this one too
 
     new_url = parsed.scheme + "://" + parsed.netloc + "/w/index.php?title=" + title
     return new_url
 
 
-def main(raw_url, convert=True):
-    url = get_page_url(raw_url)
-    wikitext, times = get_wikitext(url)
-
-    code = mwparserfromhell.parse(wikitext)
+def hyphenate(code, convert=True):
+    """Hyphenate the ISBNs in parsed wikitext in place, returning the count"""
     count = 0
     for template, raw_isbn, para in find_isbns(code):
-        if not check_isbn(raw_isbn):
+        new_isbn = normalize_isbn(raw_isbn, convert)
+        if new_isbn is None:
             continue
 
-        new_isbn = isbn.format(raw_isbn, convert=convert)
         if raw_isbn != new_isbn:
             count += 1
             template.add(para, new_isbn)
 
+    return count
+
+
+def main(raw_url, convert=True):
+    url = get_page_url(raw_url)
+    wikitext, times = get_wikitext(url)
+
+    code = parsing.parse(wikitext, page=url, revision=times[0], mutable=True)
+    count = hyphenate(code, convert)
+
     return code, times, count, url
 
 
+def get_wikitext_bulk(titles, site="en.wikipedia.org"):
+    """Get the wikitext of many pages, BATCH_SIZE pages per API request.
+
+    Returns a dict of each requested title to (wikitext, (edit_time,
+    start_time)), or to None if the page does not exist.
+    """
+    api_url = f"https://{site}/w/api.php"
+    pages = {}
+    for i in range(0, len(titles), BATCH_SIZE):
+        chunk = titles[i : i + BATCH_SIZE]
+        params = {
+            "action": "query",
+            "prop": "revisions",
+            "rvprop": "content|timestamp",
+            "rvslots": "main",
+            "titles": "|".join(chunk),
+            "format": "json",
+            "formatversion": "2",
+            "maxlag": "5",
+            "continue": "",
+        }
+        # Map the titles as the API returns them back to the requested ones.
+        # Several requested titles can normalize to the same page.
+        requested = {title: [title] for title in chunk}
+        while True:
+            response = retry.call(lambda: session.get(api_url, params=params))
+            start_time = time.strftime("%Y%m%d%H%M%S", time.gmtime())
+            data = response.json()
+            query = data["query"]
+
+            for norm in query.get("normalized", []):
+                titles_for = requested.setdefault(norm["to"], [])
+                if norm["from"] not in titles_for:
+                    titles_for.append(norm["from"])
+
+            for page in query["pages"]:
+                if page.get("missing") or page.get("invalid"):
+                    for title in requested.get(page["title"], [page["title"]]):
+                        pages[title] = None
+                    continue
+                elif not page.get("revisions"):
+                    # Past the result size limit, it comes in a later response
+                    continue
+                revision = page["revisions"][0]
+                edit_time = time.strftime(
+                    "%Y%m%d%H%M%S",
+                    time.strptime(revision["timestamp"], "%Y-%m-%dT%H:%M:%SZ"),
+                )
+                for title in requested.get(page["title"], [page["title"]]):
+                    pages[title] = (
+                        revision["slots"]["main"]["content"],
+                        (edit_time, start_time),
+                    )
+
+            if "continue" not in data:
+                break
+            params = {**params, **data["continue"]}
+
+    return {title: pages.get(title) for title in titles}
+
+
+def _hyphenate_text(args):
+    wikitext, convert = args
+    code = mwparserfromhell.parse(wikitext)
+    count = hyphenate(code, convert)
+    return str(code), count
+
+
+def _mp_context():
+    # Forking a process that has threads running can deadlock the child
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn"
+    )
+
+
+def batch(titles, convert=True, site="en.wikipedia.org", max_workers=1):
+    """Hyphenate many pages.
+
+    With max_workers above 1, the pages are processed in a pool of that many
+    processes. That's meant for the command line; web requests go through a
+    job instead and process the pages in the job's thread.
+
+    Returns a list with a dict for each title, in the same order.
+    """
+    titles = list(dict.fromkeys(titles))
+    wikitexts = get_wikitext_bulk(titles, site)
+    found = [title for title in titles if wikitexts[title] is not None]
+
+    work = [(wikitexts[title][0], convert) for title in found]
+    if max_workers > 1 and len(work) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            min(max_workers, len(work)), mp_context=_mp_context()
+        ) as executor:
+            results = dict(zip(found, executor.map(_hyphenate_text, work)))
+    else:
+        results = dict(zip(found, map(_hyphenate_text, work)))
+
+    output = []
+    for title in titles:
+        if title not in results:
+            output.append({"title": title, "error": "That page does not exist."})
+            continue
+        newtext, count = results[title]
+        edit_time, start_time = wikitexts[title][1]
+        output.append(
+            {
+                "title": title,
+                "count": count,
+                "newtext": newtext,
+                "edit_time": edit_time,
+                "start_time": start_time,
+                "submit_url": f"https://{site}/w/index.php?title="
+                + urllib.parse.quote(title.replace(" ", "_"), safe=":/")
+                + "&action=submit",
+            }
+        )
+    return output
+
+
 @bp.route("/", methods=["GET"])
 def form():
     return flask.render_template("hyphenator-form.html")
 
 
+@bp.route("/api/batch", methods=["POST"])
+def api_batch():
+    """Queue a list of pages to be hyphenated.
+
+    Takes a JSON object with "titles" and optionally "convert" and "site".
+    The job's result is {"pages": <the results of batch()>}.
+    """
+    data = flask.request.get_json(force=True, silent=True) or {}
+    titles = data.get("titles")
+    max_titles = flask.current_app.config.get("hyphenator_batch_max", 500)
+    if (
+        not isinstance(titles, list)
+        or not titles
+        or not all(isinstance(title, str) for title in titles)
+    ):
+        return flask.jsonify({"error": "titles must be a list of page titles"}), 400
+    if len(titles) > max_titles:
+        return flask.jsonify({"error": f"At most {max_titles} titles allowed"}), 400
+
+    job_id = jobs.submit(
+        "hyphenator_batch",
+        {
+            "titles": titles,
+            "convert": bool(data.get("convert", True)),
+            "site": data.get("site", "en.wikipedia.org"),
+        },
+    )
+    return jobs.submitted_response(job_id)
+
+
+@jobs.handler("hyphenator_batch")
+def batch_job(payload):
+    return {"pages": batch(payload["titles"], payload["convert"], payload["site"])}
+
+
+@bp.cli.command("batch")
+@click.argument("titles", nargs=-1)
+@click.option(
+    "--file", "title_file", type=click.File(), help="File with one title per line."
+)
+@click.option("--convert/--no-convert", default=True, help="Convert ISBN-10s.")
+@click.option("--site", default="en.wikipedia.org")
+@click.option("--workers", type=int, default=None, help="Number of processes.")
+def batch_command(titles, title_file, convert, site, workers):
+    """Hyphenate ISBNs on many pages, printing one JSON result per line."""
+    titles = list(titles)
+    if title_file:
+        titles.extend(line.strip() for line in title_file if line.strip())
+    max_workers = flask.current_app.config.get(
+        "hyphenator_batch_workers", os.cpu_count() or 1
+    )
+    workers = min(workers, max_workers) if workers else max_workers
+    for page in batch(titles, convert=convert, site=site, max_workers=workers):
+        click.echo(json.dumps(page))
+
+
 @bp.route("/output", methods=["POST"])
 def output():
     def check_err(messages):
@@ -134,12 +389,10 @@ def output():
         try:
             newtext, times, count, url = main(pageurl, convert)
         except Exception as err:
-            if not check_err(flash):
-                flash.append(
-                    ("An unhandled {0} exception occurred.".format(err), "danger")
-                )
+            if not check_err(get_messages()):
+                flash("An unhandled {0} exception occurred.".format(err), "danger")
 
-            for message in flash:
+            for message in get_messages():
                 flask.flash(message[0], message[1])
 
             return flask.redirect(flask.url_for("hyphenator.form"))
@@ -154,3 +407,49 @@ def output():
             edit_time=times[0],
             start_time=times[1],
         )
+
+
+@jobs.handler("hyphenator")
+def hyphenator_job(payload):
+    try:
+        newtext, times, count, url = main(payload["url"], payload["convert"])
+    except Exception as err:
+        # Report what the user would have been shown instead of the raw error
+        messages = [message for message, category in get_messages()]
+        if messages:
+            raise RuntimeError(" ".join(messages)) from err
+        raise
+    return {"newtext": str(newtext), "times": times, "count": count, "url": url}
+
+
+@bp.route("/jobs", methods=["POST"])
+def submit_job():
+    """Queue a page to be hyphenated in the background"""
+    convert = bool(flask.request.form.get("convert", False))
+    try:
+        url = get_page_url(flask.request.form["page_url"])
+    except (ValueError, KeyError):
+        return flask.jsonify({"error": "Invalid URL"}), 400
+    job_id = jobs.submit(
+        "hyphenator", {"url": url, "convert": convert}, dedup_key=f"{url}|{convert}"
+    )
+    return jobs.submitted_response(job_id)
+
+
+@bp.route("/jobs/<job_id>")
+def job_output(job_id):
+    """Show the result of a background job, or its status if it isn't done"""
+    job = jobs.queue.get(job_id)
+    if job is None or job["kind"] != "hyphenator":
+        flask.abort(404)
+    if job["status"] != "done":
+        return jobs.pending_response(job)
+    result = job["result"]
+    return flask.render_template(
+        "hyphenator-output.html",
+        count=result["count"],
+        submit_url=result["url"] + "&action=submit",
+        newtext=result["newtext"],
+        edit_time=result["times"][0],
+        start_time=result["times"][1],
+    )
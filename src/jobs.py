@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Background jobs for tools that take too long for a single request.
+
+Jobs are stored in a SQLite database, so every uwsgi worker can pick up
+jobs submitted to any other, and nothing besides the tool's own storage is
+needed. A tool registers a function with @handler(kind), then submits jobs
+with a JSON-serializable payload. Submitting a job while an identical one
+(same kind and dedup key) is queued, running, or recently finished returns
+the existing job instead of adding another.
+
+Worker threads are started in each process the first time a job is
+submitted, or when a client polling for a job finds it still waiting (the
+process that queued it may have restarted since). Clients poll
+/jobs/<job_id> for the result.
+
+Config keys:
+jobs_path -- database location, default jobs.sqlite next to this file
+job_workers -- worker threads per process, default 2
+job_result_ttl -- seconds a finished job is reused for duplicates
+job_retention -- seconds finished and failed jobs are kept, default a day
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+import flask
+
+logger = logging.getLogger(__name__)
+
+bp = flask.Blueprint("jobs", __name__, url_prefix="/jobs")
+
+handlers: Dict[str, Callable[[Any], Any]] = {}
+
+
+def handler(kind: str):
+    """Register a function to run jobs of this kind"""
+
+    def decorator(func):
+        handlers[kind] = func
+        return func
+
+    return decorator
+
+
+class JobQueue:
+    def __init__(
+        self,
+        path: str,
+        result_ttl: float = 10 * 60,
+        timeout: float = 60 * 60,
+        retention: float = 24 * 60 * 60,
+    ):
+        self.path = path
+        self.result_ttl = result_ttl
+        # Finished jobs older than this are deleted, results and all
+        self.retention = max(retention, result_ttl)
+        # Running jobs older than this are assumed lost and run again
+        self.timeout = timeout
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT, dedup_key TEXT, payload TEXT, "
+                "status TEXT, result TEXT, error TEXT, created REAL, updated REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (kind, dedup_key)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def prune(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+            (now - self.retention,),
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def submit(self, kind: str, payload, dedup_key: Optional[str] = None) -> str:
+        """Queue a job, or return the id of an identical one"""
+        if dedup_key is None:
+            dedup_key = json.dumps(payload, sort_keys=True)
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self.prune(conn, now)
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND dedup_key = ? AND ("
+                "status IN ('queued', 'running') "
+                "OR (status = 'done' AND updated > ?)) "
+                "ORDER BY created DESC LIMIT 1",
+                (kind, dedup_key, now - self.result_ttl),
+            ).fetchone()
+            if row is not None:
+                job_id = row["id"]
+            else:
+                job_id = str(uuid.uuid4())
+                conn.execute(
+                    "INSERT INTO jobs (id, kind, dedup_key, payload, status, "
+                    "created, updated) VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    (job_id, kind, dedup_key, json.dumps(payload), now, now),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return job_id
+
+    def claim(self) -> Optional[sqlite3.Row]:
+        """Mark the oldest queued job as running and return it"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' "
+                "OR (status = 'running' AND updated < ?) "
+                "ORDER BY created LIMIT 1",
+                (now - self.timeout,),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', updated = ? WHERE id = ?",
+                    (now, row["id"]),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return row
+
+    def finish(self, job_id: str, result=None, error: Optional[str] = None) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated = ? "
+                "WHERE id = ?",
+                (
+                    "failed" if error is not None else "done",
+                    json.dumps(result),
+                    error,
+                    time.time(),
+                    job_id,
+                ),
+            )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, kind, status, result, error, created, updated "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def run_one(self) -> bool:
+        """Run the next queued job, if there is one. Returns True if it did."""
+        row = self.claim()
+        if row is None:
+            return False
+        logger.info(f"Running {row['kind']} job {row['id']}")
+        try:
+            func = handlers[row["kind"]]
+            result = func(json.loads(row["payload"]))
+        except Exception as err:
+            logger.exception(f"{row['kind']} job {row['id']} failed")
+            self.finish(row["id"], error=f"{type(err).__name__}: {err}")
+        else:
+            self.finish(row["id"], result)
+        return True
+
+
+queue: Optional[JobQueue] = None
+_app = None
+_workers = []
+_workers_lock = threading.Lock()
+
+
+@bp.record_once
+def setup(state):
+    global queue, _app
+    config = state.app.config
+    path = config.get(
+        "jobs_path", os.path.join(os.path.dirname(__file__), "jobs.sqlite")
+    )
+    queue = JobQueue(
+        path,
+        result_ttl=config.get("job_result_ttl", 10 * 60),
+        retention=config.get("job_retention", 24 * 60 * 60),
+    )
+    _app = state.app
+
+
+def _work(poll_interval: float) -> None:
+    while True:
+        try:
+            with _app.app_context():
+                ran = queue.run_one()
+        except Exception:
+            logger.exception("Job worker error")
+            ran = False
+        if not ran:
+            time.sleep(poll_interval)
+
+
+def start_workers(poll_interval: float = 0.5) -> None:
+    """Start this process's worker threads, if they aren't running yet"""
+    with _workers_lock:
+        if _workers:
+            return
+        for i in range(_app.config.get("job_workers", 2)):
+            thread = threading.Thread(
+                target=_work, args=(poll_interval,), name=f"job-worker-{i}", daemon=True
+            )
+            thread.start()
+            _workers.append(thread)
+
+
+def submit(kind: str, payload, dedup_key: Optional[str] = None) -> str:
+    """Queue a job and make sure there is something to run it"""
+    job_id = queue.submit(kind, payload, dedup_key)
+    start_workers()
+    return job_id
+
+
+def pending_response(job: Dict[str, Any]):
+    """Response for a job that isn't done: an error if it failed, 202 if not"""
+    if job["status"] == "failed":
+        return flask.jsonify(job), 500
+    start_workers()
+    return flask.jsonify(job), 202
+
+
+def submitted_response(job_id: str):
+    """Response for an endpoint that has just submitted a job"""
+    status_url = flask.url_for("jobs.status", job_id=job_id)
+    response = flask.jsonify({"job_id": job_id, "status_url": status_url})
+    response.status_code = 202
+    response.headers["Location"] = status_url
+    return response
+
+
+@bp.route("/<job_id>")
+def status(job_id):
+    job = queue.get(job_id)
+    if job is None:
+        flask.abort(404)
+    if job["status"] in ("queued", "running"):
+        start_workers()
+    return flask.jsonify(job)
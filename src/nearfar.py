@@ -4,22 +4,15 @@
 # Copyright 2020 AntiCompositeNumber
 
 import flask
-import requests
 import itertools
 from werkzeug.datastructures import MultiDict
 
+from . import httpclient
+
 # import re
 
 bp = flask.Blueprint("nearfar", __name__, url_prefix="/nearfar")
-session = requests.Session()
-session.headers.update(
-    {
-        "User-Agent": "anticompositetools/nearfar "
-        "(https://anticompositetools.toolforge.org/nearfar; "
-        "tools.anticompositetools@tools.wmflabs.org) python-requests/"
-        + requests.__version__
-    }
-)
+session = httpclient.get_session("nearfar")
 
 
 @bp.route("/")
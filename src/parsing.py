@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Parse wikitext once per page revision, and index what's in it.
+
+Parsed Wikicode is cached by (page, revision), where the revision is whatever
+the caller has to identify it, such as the Last-Modified time. A hit is only
+used if the cached text is identical to the text being parsed, so a stale or
+wrong key costs a parse, never a wrong tree.
+
+Callers that only read the tree share the cached copy. Callers that modify it
+must ask for mutable=True and get their own copy, unpickled from a serialized
+form that is kept with the cache entry.
+
+index() walks a tree once and collects the ref tags and templates the tools
+look for, so they don't each traverse the whole page again.
+"""
+
+import logging
+import pickle
+from typing import Hashable, List, NamedTuple, Optional, Tuple
+
+import mwparserfromhell
+from mwparserfromhell.nodes import Tag, Template
+from mwparserfromhell.wikicode import Wikicode
+
+from . import cache
+
+logger = logging.getLogger(__name__)
+
+# Approximate memory limit in bytes, as estimated by _weigh(). Can be changed
+# with the parse_cache_size config key.
+PARSE_CACHE_SIZE = 64 * 1024 * 1024
+# A parsed tree takes about this many bytes per character of its text
+# (measured with tracemalloc at 40-60).
+TREE_WEIGHT = 60
+
+
+class _Entry:
+    __slots__ = ("text", "code", "blob")
+
+    def __init__(
+        self, text: str, code: Optional[Wikicode] = None, blob: Optional[bytes] = None
+    ):
+        self.text = text
+        # Shared tree for read-only callers
+        self.code = code
+        # Serialized tree for callers that need their own copy
+        self.blob = blob
+
+
+def _weigh(entry: _Entry) -> int:
+    weight = len(entry.text) + len(entry.blob or b"")
+    if entry.code is not None:
+        weight += TREE_WEIGHT * len(entry.text)
+    return weight
+
+
+def _dumps(code: Wikicode) -> Optional[bytes]:
+    try:
+        return pickle.dumps(code, pickle.HIGHEST_PROTOCOL)
+    except RecursionError:
+        logger.warning("Wikicode too deeply nested to serialize")
+        return None
+
+
+parse_cache = cache.LRUCache(maxsize=256, weigh=_weigh, maxweight=PARSE_CACHE_SIZE)
+
+
+def parse(
+    text: str,
+    page: Optional[Hashable] = None,
+    revision: Optional[Hashable] = None,
+    mutable: bool = False,
+) -> Wikicode:
+    """Parse text, reusing an earlier parse of the same page revision.
+
+    Without a page and revision the text is parsed without caching. Unless
+    mutable is true, the returned Wikicode may be shared and must not be
+    modified.
+    """
+    if page is None or revision is None:
+        return mwparserfromhell.parse(text)
+
+    key = (page, revision)
+    entry = parse_cache.get(key)
+    if entry is None or entry.text != text:
+        code = mwparserfromhell.parse(text)
+        if not mutable:
+            parse_cache.set(key, _Entry(text, code=code))
+        else:
+            # The caller is about to change this tree, keep a pristine copy.
+            blob = _dumps(code)
+            if blob is not None:
+                parse_cache.set(key, _Entry(text, blob=blob))
+        return code
+
+    if not mutable:
+        if entry.code is None:
+            entry.code = pickle.loads(entry.blob)
+            # Store it again so the cache accounts for the tree
+            parse_cache.set(key, entry)
+        return entry.code
+
+    if entry.blob is None:
+        blob = _dumps(entry.code)
+        if blob is None:
+            return mwparserfromhell.parse(text)
+        entry.blob = blob
+        # Store it again so the cache accounts for the serialized copy
+        parse_cache.set(key, entry)
+    return pickle.loads(entry.blob)
+
+
+class WikicodeIndex(NamedTuple):
+    # <ref> tags, in document order, with the first template inside each
+    refs: List[Tuple[Tag, Optional[Template]]]
+    # Templates that aren't nested inside anything else
+    top_templates: List[Template]
+    # Every template, in the same order as Wikicode.ifilter_templates()
+    templates: List[Template]
+
+
+def index(code: Wikicode) -> WikicodeIndex:
+    """Collect ref tags and templates from code in a single walk"""
+    top_level = {id(node) for node in code.nodes}
+    refs = []
+    top_templates = []
+    templates = []
+    for node in code.ifilter(recursive=True, forcetype=(Tag, Template)):
+        if isinstance(node, Template):
+            templates.append(node)
+            if id(node) in top_level:
+                top_templates.append(node)
+        elif node.tag.strip().lower() == "ref":
+            first_template = None
+            if node.contents is not None:
+                # Stops at the first template, so this doesn't walk the whole ref
+                first_template = next(node.contents.ifilter_templates(), None)
+            refs.append((node, first_template))
+
+    return WikicodeIndex(refs=refs, top_templates=top_templates, templates=templates)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+"""Retry with exponential backoff for requests to Wikimedia services.
+
+Delays grow exponentially with jitter, a Retry-After header (sent by the API
+for maxlag and rate limit errors) takes priority over the computed delay, and
+each request has a total deadline after which it gives up instead of
+sleeping again.
+"""
+
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import requests
+
+
+class MaxlagError(Exception):
+    """The API refused a request because of database replication lag"""
+
+
+class RetryStats:
+    """Process-wide retry counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.giveups = 0
+        self.backoff_time = 0.0
+
+    def record(self, delay: Optional[float]) -> None:
+        with self._lock:
+            if delay is None:
+                self.giveups += 1
+            else:
+                self.retries += 1
+                self.backoff_time += delay
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(
+                retries=self.retries,
+                giveups=self.giveups,
+                backoff_time=self.backoff_time,
+            )
+
+
+stats = RetryStats()
+
+
+def parse_retry_after(response) -> Optional[float]:
+    """Return the number of seconds a response asks us to wait, if any"""
+    if response is None:
+        return None
+    value = response.headers.get("Retry-After")
+    if not isinstance(value, str):
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class Backoff:
+    """Retry policy. Call start() for each request to get an Attempts tracker.
+
+    args:
+    tries -- maximum number of attempts, including the first
+    base -- delay before the first retry, in seconds
+    factor -- multiplier applied to the delay after each retry
+    max_delay -- upper bound for a single delay
+    deadline -- total time budget for the request, including delays
+    jitter -- if true, randomize each delay between half and all of its value
+    """
+
+    def __init__(
+        self,
+        tries: int = 4,
+        base: float = 1.0,
+        factor: float = 2.0,
+        max_delay: float = 30.0,
+        deadline: Optional[float] = 60.0,
+        jitter: bool = True,
+    ):
+        self.tries = tries
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+
+    def start(self) -> "Attempts":
+        return Attempts(self)
+
+
+class Attempts:
+    """Retry state for a single request"""
+
+    def __init__(self, policy: Backoff):
+        self.policy = policy
+        self.started = time.monotonic()
+        self.count = 1
+
+    def next_delay(self, response=None) -> Optional[float]:
+        """How long to wait before the next attempt, or None to give up"""
+        policy = self.policy
+        if self.count >= policy.tries:
+            return None
+
+        delay = parse_retry_after(response)
+        if delay is None:
+            delay = min(
+                policy.max_delay, policy.base * policy.factor ** (self.count - 1)
+            )
+            if policy.jitter:
+                delay = random.uniform(delay / 2, delay)
+
+        if policy.deadline is not None:
+            elapsed = time.monotonic() - self.started
+            if elapsed + delay > policy.deadline:
+                return None
+        return delay
+
+    def _advance(self, response) -> Optional[float]:
+        delay = self.next_delay(response)
+        stats.record(delay)
+        if delay is not None:
+            self.count += 1
+        return delay
+
+    def sleep(self, response=None) -> bool:
+        """Block until the next attempt. Returns False if it's time to give up."""
+        delay = self._advance(response)
+        if delay is None:
+            return False
+        time.sleep(delay)
+        return True
+
+    async def sleep_async(self, response=None) -> bool:
+        """Like sleep(), but yields to the event loop while waiting."""
+        delay = self._advance(response)
+        if delay is None:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+
+default = Backoff()
+
+
+def check_response(response) -> None:
+    """Raise for HTTP errors and for API maxlag errors"""
+    response.raise_for_status()
+    if response.headers.get("MediaWiki-API-Error") == "maxlag":
+        raise MaxlagError(response.headers.get("X-Database-Lag", ""))
+
+
+def is_retryable(response) -> bool:
+    """Connection errors, server errors, rate limits and maxlag are retryable"""
+    if response is None:
+        return True
+    if response.headers.get("MediaWiki-API-Error") == "maxlag":
+        return True
+    return response.status_code >= 500 or response.status_code == 429
+
+
+def call(
+    send: Callable[[], requests.Response], policy: Optional[Backoff] = None
+) -> requests.Response:
+    """Call send() until it returns a successful response or retries run out.
+
+    Errors that won't go away on their own, like a 404, are raised at once.
+    """
+    attempts = (policy or default).start()
+    while True:
+        response = None
+        try:
+            response = send()
+            check_response(response)
+        except Exception:
+            if not is_retryable(response) or not attempts.sleep(response):
+                raise
+        else:
+            return response
+
+
+async def call_async(send, policy: Optional[Backoff] = None):
+    """Like call(), for a coroutine function returning a requests-like response"""
+    attempts = (policy or default).start()
+    while True:
+        response = None
+        try:
+            response = await send()
+            check_response(response)
+        except Exception:
+            if not is_retryable(response) or not await attempts.sleep_async(response):
+                raise
+        else:
+            return response
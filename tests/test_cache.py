@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest
+import unittest.mock as mock
+import sys
+import os
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/.."))
+import src.cache as cache  # noqa: E402
+
+
+def test_lru_eviction():
+    c = cache.LRUCache(maxsize=2)
+    c.set("a", 1)
+    c.set("b", 2)
+    assert c.get("a") == 1
+    c.set("c", 3)
+
+    assert "b" not in c
+    assert c["a"] == 1
+    assert c["c"] == 3
+    assert c.stats()["evictions"] == 1
+
+
+def test_lru_ttl():
+    c = cache.LRUCache(ttl=10)
+    with mock.patch("time.monotonic", return_value=100):
+        c["a"] = 1
+    with mock.patch("time.monotonic", return_value=105):
+        assert c.get("a") == 1
+    with mock.patch("time.monotonic", return_value=111):
+        assert c.get("a") is None
+        with pytest.raises(KeyError):
+            c["a"]
+
+
+def test_lru_stats():
+    c = cache.LRUCache()
+    c.set("a", 1)
+    c.get("a")
+    c.get("b")
+    assert c.stats() == {
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+        "size": 1,
+        "weight": 0,
+    }
+
+
+def test_lru_maxweight():
+    c = cache.LRUCache(weigh=len, maxweight=10)
+    c.set("a", "aaaa")
+    c.set("b", "bbbb")
+    c.set("a", "aaaaa")
+    assert c.weight == 9
+    c.set("c", "cc")
+
+    assert "b" not in c
+    assert c.weight == 7
+
+
+def test_sqlite(tmp_path):
+    path = str(tmp_path / "cache.db")
+    c = cache.SQLiteCache(path, maxsize=2)
+    c.set("a", {"title": "Foo"})
+    c.set("b", [1, 2])
+    c.get("a")
+    c.set("c", "bar")
+
+    # Values persist between instances
+    d = cache.SQLiteCache(path, maxsize=2)
+    assert d.get("a") == {"title": "Foo"}
+    assert d.get("b") is None
+    assert d.get("c") == "bar"
+
+
+def test_sqlite_ttl(tmp_path):
+    c = cache.SQLiteCache(str(tmp_path / "cache.db"), ttl=10)
+    with mock.patch("time.time", return_value=100):
+        c.set("a", 1)
+    with mock.patch("time.time", return_value=111):
+        assert c.get("a") is None
+    assert c.stats()["size"] == 0
+
+
+def test_tiered_promotes(tmp_path):
+    disk = cache.SQLiteCache(str(tmp_path / "cache.db"))
+    disk.set("a", 1)
+    c = cache.TieredCache(cache.LRUCache(), disk)
+
+    assert c.get("a") == 1
+    assert c.memory.get("a") == 1
+    assert c.get("b", "default") == "default"
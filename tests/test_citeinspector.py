@@ -6,9 +6,12 @@
 import pytest
 import requests
 import mwparserfromhell as mwph
+from fuzzywuzzy import fuzz
 import unittest.mock as mock
 import sys
 import os
+import threading
+import time
 
 sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/.."))
 import src.citeinspector as citeinspector  # noqa: E402
@@ -128,6 +131,94 @@ def test_get_citoid_template_types():
         assert item in supported_templates
 
 
+def test_citoid_type_map_revalidate():
+    first = mock.MagicMock(status_code=200, headers={"Last-Modified": "yesterday"})
+    first.json.return_value = {"book": "Cite book"}
+    second = mock.MagicMock(status_code=304, headers={})
+    retry = mock.MagicMock(side_effect=[first, second])
+
+    citeinspector.CitoidTypeMap.clear()
+    try:
+        with mock.patch("src.citeinspector.get_retry", retry):
+            assert citeinspector.CitoidTypeMap.get(None) == {"book": "Cite book"}
+            # Fresh, no request
+            assert citeinspector.CitoidTypeMap.get(None) == {"book": "Cite book"}
+            assert retry.call_count == 1
+
+            citeinspector.CitoidTypeMap.last_check -= (
+                2 * citeinspector.CitoidTypeMap.ttl
+            )
+            assert citeinspector.CitoidTypeMap.get(None) == {"book": "Cite book"}
+    finally:
+        citeinspector.CitoidTypeMap.clear()
+
+    assert retry.call_count == 2
+    assert retry.call_args.kwargs["extra_headers"] == {"If-Modified-Since": "yesterday"}
+
+
+def test_citoid_type_map_stale_on_error():
+    first = mock.MagicMock(status_code=200, headers={})
+    first.json.return_value = {"book": "Cite book"}
+    retry = mock.MagicMock(side_effect=[first, requests.ConnectionError])
+
+    citeinspector.CitoidTypeMap.clear()
+    try:
+        with mock.patch("src.citeinspector.get_retry", retry):
+            assert citeinspector.CitoidTypeMap.get(None) == {"book": "Cite book"}
+            citeinspector.CitoidTypeMap.last_check -= (
+                2 * citeinspector.CitoidTypeMap.ttl
+            )
+            # Revalidation fails, the old map is still served
+            assert citeinspector.CitoidTypeMap.get(None) == {"book": "Cite book"}
+            # And it isn't tried again straight away
+            assert citeinspector.CitoidTypeMap.get(None) == {"book": "Cite book"}
+    finally:
+        citeinspector.CitoidTypeMap.clear()
+
+    assert retry.call_count == 2
+
+
+def test_citoid_type_map_single_flight():
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_revalidate():
+        started.set()
+        release.wait(5)
+        return mock.MagicMock(status_code=304, headers={})
+
+    def get_retry(*args, **kwargs):
+        if retry.call_count == 1:
+            first = mock.MagicMock(status_code=200, headers={})
+            first.json.return_value = {"book": "Cite book"}
+            return first
+        return slow_revalidate()
+
+    retry = mock.MagicMock(side_effect=get_retry)
+
+    citeinspector.CitoidTypeMap.clear()
+    try:
+        with mock.patch("src.citeinspector.get_retry", retry):
+            citeinspector.CitoidTypeMap.get(None)
+            citeinspector.CitoidTypeMap.last_check -= (
+                2 * citeinspector.CitoidTypeMap.ttl
+            )
+            thread = threading.Thread(
+                target=citeinspector.CitoidTypeMap.get, args=(None,)
+            )
+            thread.start()
+            assert started.wait(5)
+            # Doesn't wait for the revalidation in progress
+            assert citeinspector.CitoidTypeMap.get(None) == {"book": "Cite book"}
+            release.set()
+            thread.join(5)
+    finally:
+        release.set()
+        citeinspector.CitoidTypeMap.clear()
+
+    assert retry.call_count == 2
+
+
 def test_find_refs():
     with open("tests/testdata.txt") as f:
         text = f.read()
@@ -156,6 +247,50 @@ def test_find_refs_wrongtemplate():
     assert len(refs) == 0
 
 
+def test_find_refs_locator():
+    with open("tests/testdata.txt") as f:
+        code = mwph.parse(f.read())
+
+    wikicode_index = citeinspector.parsing.index(code)
+    for ref in citeinspector.find_refs(code, ["Cite book"], wikicode_index):
+        templates = citeinspector.locate_templates(code, wikicode_index, ref)
+        assert len(templates) == 1
+        assert str(templates[0].name).strip() == "cite book"
+        assert str(templates[0]) in ref["wikitext"]
+
+
+def test_find_refs_duplicate_named():
+    ref = '<ref name="x">{{cite book|title=Foo|isbn=1}}</ref>'
+    code = mwph.parse(f"A{ref} B{ref} C{{{{cite book|title=Foo}}}}")
+    wikicode_index = citeinspector.parsing.index(code)
+    # citeinspector() keys its output by name, so only the last copy is kept
+    cites = {
+        cite["name"]: cite
+        for cite in citeinspector.find_refs(code, ["Cite book"], wikicode_index)
+    }
+    assert len(cites) == 2
+
+    for template in citeinspector.locate_templates(code, wikicode_index, cites["x"]):
+        template.add("title", "Bar")
+    assert str(code) == (
+        'A<ref name="x">{{cite book|title=Bar|isbn=1}}</ref> '
+        'B<ref name="x">{{cite book|title=Bar|isbn=1}}</ref> '
+        "C{{cite book|title=Foo}}"
+    )
+
+
+def test_locate_templates_fallback():
+    code = mwph.parse("<ref>{{cite book|title=A}}</ref>{{cite book|title=B}}")
+    wikicode_index = citeinspector.parsing.index(code)
+    cite = {"wikitext": "{{cite book|title=B}}", "locators": [["text", 5]]}
+    assert citeinspector.locate_templates(code, wikicode_index, cite) == [code.get(1)]
+
+    cite = {"wikitext": "<ref>{{cite book|title=A}}</ref>"}
+    assert citeinspector.locate_templates(code, wikicode_index, cite) == [
+        code.get(0).contents.get(0)
+    ]
+
+
 def test_get_bib_ident_isbn():
     data = {
         "data": {
@@ -290,6 +425,26 @@ def test_fuzz_seq():
     assert citeinspector.fuzz_seq(lista, listb) == 56
 
 
+def test_fuzz_seq_matches_fuzzywuzzy():
+    words = ["The", "Quick,", "brown", "Fox.", "Über", "dög", "(1999)", "東京", ""]
+    for i in range(len(words)):
+        set_a = words[i:] + words[: i // 2]
+        set_b = words[::-1][i:]
+        str_a = "".join(item + " " for item in set_a)
+        str_b = "".join(item + " " for item in set_b)
+        assert citeinspector.fuzz_seq(set_a, set_b) == fuzz.token_set_ratio(
+            str_a, str_b
+        )
+
+
+def test_fuzz_item_shortcuts():
+    with mock.patch("fuzzywuzzy.fuzz.partial_ratio") as m:
+        assert citeinspector.fuzz_item("", "") == 100
+        assert citeinspector.fuzz_item("Foo", "Foo") == 100
+        assert citeinspector.fuzz_item("", "Foo") == 0
+    m.assert_not_called()
+
+
 @pytest.mark.skip()
 def test_get_citoid_data_isbn():
     s = requests.Session()
@@ -320,6 +475,67 @@ def test_get_citoid_data_invalid_ident():
     assert data is None
 
 
+def test_get_citoid_data_bulk_order():
+    def fake_citoid(ident, session):
+        # Finish the first lookups last
+        time.sleep(0.01 * (5 - int(ident)))
+        return {"ident": ident}
+
+    idents = [str(i) for i in range(5)]
+    with mock.patch("src.citeinspector.get_citoid_data", fake_citoid):
+        data = citeinspector.get_citoid_data_bulk(idents, None, max_workers=5)
+
+    assert data == [{"ident": ident} for ident in idents]
+
+
+def test_get_citoid_data_bulk_empty():
+    assert citeinspector.get_citoid_data_bulk([], None) == []
+
+
+def test_iter_citoid_data_completion_order():
+    # Each lookup finishes only when the test says so, last one first
+    done = {ident: threading.Event() for ident in ["0", "1", "2"]}
+
+    def fake_citoid(ident, session):
+        assert done[ident].wait(5)
+        return {"ident": ident}
+
+    refs = [({"name": ident}, ident) for ident in ["0", "1", "2"]]
+    results = []
+    with mock.patch("src.citeinspector.get_citoid_data", fake_citoid):
+        cites = citeinspector.iter_citoid_data(refs, None, max_workers=3)
+        for ident in ["2", "1", "0"]:
+            done[ident].set()
+            results.append(next(cites))
+        assert next(cites, None) is None
+
+    assert [ref[1] for ref, data in results] == ["2", "1", "0"]
+    assert all(data == {"ident": ref[1]} for ref, data in results)
+
+
+def test_normalize_ident():
+    assert citeinspector.normalize_ident(" 978-1-78675-104-1 ") == "9781786751041"
+    assert citeinspector.normalize_ident("0-8044-2957-x") == "080442957X"
+    assert citeinspector.normalize_ident("10.1000/ABC") == "10.1000/abc"
+    assert citeinspector.normalize_ident("https://example.com/A") == (
+        "https://example.com/A"
+    )
+
+
+def test_get_citoid_data_cached():
+    retry = mock.MagicMock(return_value=[{"title": "Foo"}])
+    with mock.patch(
+        "src.citeinspector.citoid_cache",
+        citeinspector.cache.TieredCache(citeinspector.cache.LRUCache()),
+    ):
+        with mock.patch("src.citeinspector.get_retry", retry):
+            first = citeinspector.get_citoid_data("978-1-78675-104-1", None)
+            second = citeinspector.get_citoid_data("9781786751041", None)
+
+    assert first == second == {"title": "Foo"}
+    assert retry.call_count == 1
+
+
 def test_map_citoid_to_templates():
     raw_citoid_data = {
         "ISBN": ["978-1-78675-104-1", "1-78675-104-6"],
@@ -380,12 +596,39 @@ def test_get_TemplateData_map():
     assert data.get("title") == "Template:Cite web"
 
 
+def test_fill_templatedata_cache():
+    def fake_retry(url, session, method, output, data):
+        return {
+            "pages": {
+                str(i): {"title": title, "params": {}}
+                for i, title in enumerate(data["titles"].split("|"))
+            }
+        }
+
+    retry = mock.MagicMock(side_effect=fake_retry)
+    td_cache = citeinspector.cache.LRUCache()
+    td_cache["Cite web"] = {"title": "Template:Cite web"}
+    with mock.patch("src.citeinspector.templatedata_cache", td_cache):
+        with mock.patch("src.citeinspector.get_retry", retry):
+            citeinspector.fill_templatedata_cache(
+                ["Cite book", "Cite web", "Cite journal", "Cite book"], None
+            )
+
+    assert retry.call_count == 1
+    assert retry.call_args.kwargs["data"]["titles"] == (
+        "Template:Cite book|Template:Cite journal"
+    )
+    assert td_cache["Cite book"]["title"] == "Template:Cite book"
+    assert td_cache["Cite journal"]["title"] == "Template:Cite journal"
+
+
 def test_get_retry_servererr():
     s = mock.MagicMock()
     response = mock.MagicMock()
     response.raise_for_status.side_effect = Exception("internal server error")
-    response.status_code == 500
+    response.status_code = 500
     response.text = ""
+    response.headers = {}
     mock_sleep = mock.MagicMock()
     s.get.return_value = response
 
@@ -393,10 +636,31 @@ def test_get_retry_servererr():
         with pytest.raises(Exception):
             citeinspector.get_retry("http://example.com", s)
 
-    assert mock_sleep.mock_calls == [mock.call(5), mock.call(10), mock.call(15)]
+    delays = [call.args[0] for call in mock_sleep.mock_calls]
+    assert len(delays) == 3
+    assert 0.5 <= delays[0] <= 1
+    assert 1 <= delays[1] <= 2
+    assert 2 <= delays[2] <= 4
     assert s.get.call_count == 4
 
 
+def test_get_retry_retry_after():
+    s = mock.MagicMock()
+    response = mock.MagicMock()
+    response.raise_for_status.side_effect = Exception("too many requests")
+    response.status_code = 429
+    response.text = ""
+    response.headers = {"Retry-After": "7"}
+    ok = mock.MagicMock(headers={})
+    mock_sleep = mock.MagicMock()
+    s.get.side_effect = [response, ok]
+
+    with mock.patch("time.sleep", mock_sleep):
+        assert citeinspector.get_retry("http://example.com", s) is ok
+
+    assert mock_sleep.mock_calls == [mock.call(7.0)]
+
+
 def test_get_retry_badmethod():
     with pytest.raises(NotImplementedError):
         citeinspector.get_retry(
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest
+import datetime
+import time
+import unittest.mock as mock
+import sys
+import os
+import threading
+
+import flask
+import pywikibot
+from werkzeug.datastructures import MultiDict
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/.."))
+# dsalerts connects to the wiki when it is imported
+with mock.patch("pywikibot.Site"):
+    import src.dsalerts as dsalerts  # noqa: E402
+import src.dsdata as dsdata  # noqa: E402
+import src.retry as retry  # noqa: E402
+
+
+def test_submit_request_retry():
+    request = mock.MagicMock()
+    request.return_value.submit.side_effect = [
+        pywikibot.exceptions.ServerError("502"),
+        {"query": {}},
+    ]
+    with mock.patch("src.dsalerts.Request", request), mock.patch(
+        "src.retry.time.sleep"
+    ) as mock_sleep:
+        assert dsalerts.submit_request({"action": "query"}) == {"query": {}}
+
+    assert request.call_count == 2
+    assert request.call_args.kwargs["max_retries"] == 0
+    mock_sleep.assert_called_once()
+
+
+def test_submit_request_giveup():
+    request = mock.MagicMock()
+    request.return_value.submit.side_effect = pywikibot.exceptions.ServerError("502")
+    with mock.patch("src.dsalerts.Request", request), mock.patch(
+        "src.retry.time.sleep"
+    ), mock.patch.object(retry, "default", retry.Backoff(tries=3)):
+        with pytest.raises(pywikibot.exceptions.ServerError):
+            dsalerts.submit_request({"action": "query"})
+
+    assert request.call_count == 3
+
+
+def test_submit_request_other_error():
+    request = mock.MagicMock()
+    request.return_value.submit.side_effect = pywikibot.exceptions.APIError(
+        "badparams", "Bad params"
+    )
+    with mock.patch("src.dsalerts.Request", request):
+        with pytest.raises(pywikibot.exceptions.APIError):
+            dsalerts.submit_request({"action": "query"})
+
+    assert request.call_count == 1
+
+
+@pytest.fixture
+def topic_index():
+    cases = {
+        "Arab–Israeli conflict": {"page": "WP:ARBPIA", "codes": ["a-i", "pia"]},
+        "Biographies of living persons": {"page": "WP:BLPDS", "codes": ["blp"]},
+    }
+    index = dsdata.TopicIndex.build({}, cases, {}, time.time())
+    with mock.patch.object(dsalerts.DsTopics, "_index", index):
+        yield index
+
+
+def hit(log_id, *added_lines):
+    return {
+        "id": log_id,
+        "user": "Bob",
+        "timestamp": "2020-01-01T12:00:00Z",
+        "result": "tag",
+        "details": {"page_title": "Alice", "added_lines": list(added_lines)},
+    }
+
+
+def test_parse_alert_data_positions(topic_index):
+    alerts = dsalerts.parse_alert_data(
+        hit(
+            7,
+            "{{subst:alert|blp}}",
+            "{{subst:alert|topic=nothing}} {{subst:alert|pia}}",
+            "{{subst:alert|blp}}",
+        )
+    )
+    assert [(alert.topic_code, alert.log_id, alert.position) for alert in alerts] == [
+        ("blp", 7, 0),
+        ("a-i", 7, 2),
+        ("blp", 7, 3),
+    ]
+
+
+def test_sync_store_lag(tmp_path):
+    store = dsdata.AlertStore(str(tmp_path / "dsalerts.sqlite"))
+    fetch = mock.Mock(return_value=[])
+    now = datetime.datetime(2020, 1, 1, 12, 30, 45)
+    with mock.patch.object(dsalerts, "store", store), mock.patch.object(
+        dsalerts, "get_ds_alert_hits", fetch
+    ), mock.patch("src.dsalerts.datetime") as mock_datetime:
+        mock_datetime.datetime.utcnow.return_value = now
+        # The last few minutes aren't synced yet
+        assert not dsalerts.sync_store(datetime.datetime(2020, 1, 1), now)
+        assert dsalerts.sync_store(
+            datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 1, 12)
+        )
+
+    fetch.assert_called_once_with(
+        datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 1, 12, 25)
+    )
+
+
+def test_fetch_limit(tmp_path, topic_index):
+    store = dsdata.AlertStore(str(tmp_path / "dsalerts.sqlite"))
+    response = {
+        "query": {"abuselog": [hit(1, "{{subst:alert|blp}}")]},
+        "continue": {"aflstart": "2020-01-01T12:00:00Z"},
+    }
+    start, end = datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 2)
+    with mock.patch.object(dsalerts, "submit_request", return_value=response):
+        with pytest.raises(dsalerts.FetchLimitError):
+            store.sync(dsalerts.get_ds_alert_hits, start, end)
+
+    # Nothing was marked as fetched
+    assert store.coverage() == []
+
+
+@pytest.fixture
+def ds_topics(tmp_path):
+    with mock.patch.multiple(
+        dsalerts.DsTopics,
+        _index=None,
+        _refreshing=False,
+        _last_attempt=0.0,
+        cache_path=str(tmp_path / "dstopics.json"),
+    ):
+        yield dsalerts.DsTopics
+
+
+def stale_index(cases=None):
+    cases = cases or {"Biographies of living persons": {"page": "", "codes": ["blp"]}}
+    return dsdata.TopicIndex.build({}, cases, {}, time.time() - 2 * 60 * 60)
+
+
+def wait_for_refresh(ds_topics):
+    for thread in threading.enumerate():
+        if thread.name == "dstopics-refresh":
+            thread.join(5)
+    assert not ds_topics._refreshing
+
+
+def test_ds_topics_single_flight(ds_topics):
+    old = ds_topics._index = stale_index()
+    new = dsdata.TopicIndex.build({}, {}, {}, time.time())
+    release = threading.Event()
+
+    def get_data():
+        assert release.wait(5)
+        ds_topics._index = new
+
+    with mock.patch.object(ds_topics, "get_data", side_effect=get_data) as mock_get:
+        # Every caller gets the old copy while one refresh runs
+        assert ds_topics.index() is old
+        assert ds_topics.index() is old
+        release.set()
+        wait_for_refresh(ds_topics)
+        assert ds_topics.index() is new
+
+    mock_get.assert_called_once()
+
+
+def test_ds_topics_failed_refresh(ds_topics):
+    old = ds_topics._index = stale_index()
+    with mock.patch.object(
+        ds_topics, "get_data", side_effect=ConnectionError
+    ) as mock_get:
+        assert ds_topics.index() is old
+        wait_for_refresh(ds_topics)
+        # Not tried again until retry_after has passed
+        assert ds_topics.index() is old
+        mock_get.assert_called_once()
+
+        ds_topics._last_attempt -= ds_topics.retry_after + 1
+        assert ds_topics.index() is old
+        wait_for_refresh(ds_topics)
+    assert mock_get.call_count == 2
+
+
+def test_ds_topics_save_load(ds_topics):
+    saved = ds_topics._index = stale_index()
+    ds_topics.save()
+    ds_topics._index = None
+
+    with mock.patch.object(ds_topics, "get_data") as mock_get, mock.patch(
+        "threading.Thread"
+    ):
+        index = ds_topics.index()
+    mock_get.assert_not_called()
+    assert index == saved
+    assert index.normalize("BLP") == "blp"
+
+
+def test_ds_topics_load_missing(ds_topics):
+    assert not ds_topics.load()
+    with open(ds_topics.cache_path, "w") as f:
+        f.write("{")
+    assert not ds_topics.load()
+
+
+def test_data_query_defaults():
+    now = datetime.datetime(2021, 3, 31, 15, 30, 10)
+    query = dsalerts.DataQuery.from_args(MultiDict({"resolution": "day"}), now)
+    assert query == dsalerts.DataQuery(
+        start_date=datetime.datetime(2021, 2, 28),
+        end_date=datetime.datetime(2021, 3, 31, 23, 59, 59),
+        resolution="day",
+        filters=(),
+    )
+    # The default query is the same all day
+    later = now.replace(hour=23)
+    assert dsalerts.DataQuery.from_args(MultiDict({"resolution": "day"}), later) == (
+        query
+    )
+
+
+def test_data_query_canonical(topic_index):
+    args = MultiDict(
+        [
+            ("resolution", "month"),
+            ("start_date", "2020-01-01"),
+            ("end_date", "2020-01-31"),
+            ("topic", "PIA|blp"),
+            ("sending_user", "Bob"),
+            ("sending_user", "Alice|Bob"),
+        ]
+    )
+    query = dsalerts.DataQuery.from_args(args)
+    assert query.end_date == datetime.datetime(2020, 1, 31, 23, 59, 59)
+    assert query.filters == (
+        ("sending_user", ("Alice", "Bob")),
+        ("topic_code", ("a-i", "blp")),
+    )
+
+    reordered = MultiDict(
+        [
+            ("topic", "blp|a-i"),
+            ("sending_user", "Alice|Bob"),
+            ("end_date", "2020-01-31"),
+            ("start_date", "2020-01-01"),
+            ("resolution", "month"),
+        ]
+    )
+    assert dsalerts.DataQuery.from_args(reordered) == query
+
+
+@pytest.fixture
+def response_cache():
+    with mock.patch.object(
+        dsalerts, "response_cache", dsalerts.cache.LRUCache()
+    ) as response_cache, mock.patch.object(
+        dsalerts, "timeseries_data", return_value={"Total": {"Total": 0}}
+    ):
+        yield response_cache
+
+
+def test_get_cached_data_ttl(response_cache):
+    closed = dsalerts.DataQuery(
+        datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 31), "day", ()
+    )
+    open_range = closed._replace(end_date=datetime.datetime(2999, 1, 1))
+
+    with mock.patch.object(response_cache, "set", wraps=response_cache.set) as set:
+        first = dsalerts.get_cached_data(closed)
+        assert dsalerts.get_cached_data(closed) is first
+        dsalerts.get_cached_data(open_range)
+
+    assert [call.kwargs["ttl"] for call in set.call_args_list] == [
+        dsalerts.RESPONSE_TTL_CLOSED,
+        dsalerts.RESPONSE_TTL_OPEN,
+    ]
+    assert dsalerts.timeseries_data.call_count == 2
+
+
+def test_api_data_etag(response_cache):
+    app = flask.Flask(__name__)
+    args = "?resolution=day&start_date=2020-01-01&end_date=2020-01-31"
+
+    with app.test_request_context(f"/dsalerts/api/data{args}"):
+        response = dsalerts.api_data()
+    assert response.status_code == 200
+    assert response.json == {"Total": {"Total": 0}}
+    assert response.cache_control.public
+    assert response.cache_control.max_age > 0
+    etag, _ = response.get_etag()
+
+    with app.test_request_context(
+        f"/dsalerts/api/data{args}", headers={"If-None-Match": f'"{etag}"'}
+    ):
+        response = dsalerts.api_data()
+    assert response.status_code == 304
+    assert dsalerts.timeseries_data.call_count == 1
+
+
+def test_get_cached_data_incomplete(tmp_path):
+    store = dsdata.AlertStore(str(tmp_path / "dsalerts.sqlite"))
+    day = datetime.timedelta(days=1)
+    midnight = datetime.datetime.combine(
+        datetime.datetime.utcnow().date(), datetime.time()
+    )
+    store.add([], 0, dsdata.to_epoch(midnight - 3 * day))
+    # Ends two days ago, so it is closed even just after midnight
+    query = dsalerts.DataQuery(
+        midnight - 5 * day, midnight - day - datetime.timedelta(seconds=1), "day", ()
+    )
+    cache = dsalerts.cache.LRUCache()
+
+    with mock.patch.object(dsalerts, "store", store), mock.patch.object(
+        dsalerts, "response_cache", cache
+    ), mock.patch.object(cache, "set", wraps=cache.set) as set, mock.patch.object(
+        dsalerts, "get_ds_alert_hits"
+    ) as fetch:
+        # Another request is fetching the rest of the range
+        with store._sync_lock:
+            dsalerts.get_cached_data(query)
+        fetch.assert_not_called()
+        assert set.call_args.kwargs["ttl"] == dsalerts.RESPONSE_TTL_OPEN
+
+        cache.clear()
+        fetch.return_value = []
+        dsalerts.get_cached_data(query)
+        assert set.call_args.kwargs["ttl"] == dsalerts.RESPONSE_TTL_CLOSED
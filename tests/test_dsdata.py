@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest
+import datetime
+import random
+import unittest.mock as mock
+import sys
+import os
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/.."))
+import src.dsdata as dsdata  # noqa: E402
+
+
+def dt(*args):
+    return datetime.datetime(*args)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return dsdata.AlertStore(str(tmp_path / "dsalerts.sqlite"))
+
+
+def test_epoch_roundtrip():
+    date = dt(2020, 5, 6, 7, 8, 9)
+    assert dsdata.to_epoch(date) == 1588748889
+    assert dsdata.from_epoch(dsdata.to_epoch(date)) == date
+
+
+@pytest.mark.parametrize(
+    "date,expected",
+    [
+        (dt(2020, 3, 15, 12), dt(2020, 2, 15, 12)),
+        (dt(2021, 1, 10), dt(2020, 12, 10)),
+        (dt(2020, 3, 31), dt(2020, 2, 29)),
+        (dt(2021, 3, 31), dt(2021, 2, 28)),
+        (dt(2020, 5, 31), dt(2020, 4, 30)),
+    ],
+)
+def test_month_before(date, expected):
+    assert dsdata.month_before(date) == expected
+
+
+def test_is_closed():
+    lag = datetime.timedelta(minutes=5)
+    yesterday = dt(2020, 1, 1, 23, 59, 59)
+    assert not dsdata.is_closed(yesterday, dt(2020, 1, 1, 12), lag)
+    # Just after midnight, the end of yesterday may still be coming in
+    assert not dsdata.is_closed(yesterday, dt(2020, 1, 2, 0, 3), lag)
+    assert dsdata.is_closed(yesterday, dt(2020, 1, 2, 0, 5, 30), lag)
+    assert dsdata.synced_until(dt(2020, 1, 2, 0, 5, 30), lag) == dt(2020, 1, 2, 0, 0)
+
+
+def test_gaps_and_coverage(store):
+    assert store.gaps(0, 100) == [(0, 100)]
+    store.add([], 10, 20)
+    store.add([], 40, 50)
+    assert store.gaps(0, 100) == [(0, 9), (21, 39), (51, 100)]
+    assert store.gaps(12, 45) == [(21, 39)]
+    assert store.gaps(12, 18) == []
+
+    # Adjacent and overlapping ranges are merged
+    store.add([], 21, 45)
+    assert store.coverage() == [(10, 50)]
+    assert store.newest() == 50
+
+
+def test_sync_fetches_only_gaps(store):
+    alerts = [
+        dsdata.DsAlert(dt(2020, 1, 1, 12), "Alice", "Bob", "ap", 1),
+        dsdata.DsAlert(dt(2020, 1, 3, 12), "Carol", "Bob", "blp", 2),
+        dsdata.DsAlert(dt(2020, 1, 5, 12), "Dave", "Erin", "ap", 3),
+    ]
+
+    def fetch(start, end):
+        return [alert for alert in alerts if start <= alert.timestamp <= end]
+
+    fetch = mock.Mock(side_effect=fetch)
+    store.sync(fetch, dt(2020, 1, 2), dt(2020, 1, 4))
+    fetch.assert_called_once_with(dt(2020, 1, 2), dt(2020, 1, 4))
+    assert list(store.query(dt(2020, 1, 1), dt(2020, 1, 10))) == alerts[1:2]
+
+    fetch.reset_mock()
+    store.sync(fetch, dt(2020, 1, 1), dt(2020, 1, 6))
+    assert fetch.call_args_list == [
+        mock.call(dt(2020, 1, 1), dt(2020, 1, 1, 23, 59, 59)),
+        mock.call(dt(2020, 1, 4, 0, 0, 1), dt(2020, 1, 6)),
+    ]
+    assert list(store.query(dt(2020, 1, 1), dt(2020, 1, 6))) == alerts
+
+    fetch.reset_mock()
+    store.sync(fetch, dt(2020, 1, 1), dt(2020, 1, 6))
+    fetch.assert_not_called()
+
+
+def test_sync_forward(store):
+    fetch = mock.Mock(return_value=[])
+    store.sync_forward(fetch, dt(2020, 1, 10))
+    fetch.assert_not_called()
+
+    store.sync(fetch, dt(2020, 1, 1), dt(2020, 1, 5))
+    fetch.reset_mock()
+    store.sync_forward(fetch, dt(2020, 1, 10))
+    fetch.assert_called_once_with(dt(2020, 1, 5, 0, 0, 1), dt(2020, 1, 10))
+    assert store.coverage() == [
+        (dsdata.to_epoch(dt(2020, 1, 1)), dsdata.to_epoch(dt(2020, 1, 10)))
+    ]
+
+
+def test_add_duplicates(store):
+    alert = dsdata.DsAlert(dt(2020, 1, 1, 12), "Alice", "Bob", "ap", 1)
+    store.add([alert], 0, 10)
+    store.add([alert], 5, 20)
+    assert list(store.query(dt(2020, 1, 1), dt(2020, 1, 2))) == [alert]
+
+
+def test_add_same_details(store):
+    # One edit giving the same alert twice, and another edit at the same time
+    alerts = [
+        dsdata.DsAlert(dt(2020, 1, 1, 12), "Alice", "Bob", "ap", 1, 0),
+        dsdata.DsAlert(dt(2020, 1, 1, 12), "Alice", "Bob", "ap", 1, 1),
+        dsdata.DsAlert(dt(2020, 1, 1, 12), "Alice", "Bob", "ap", 2, 0),
+    ]
+    store.add(alerts, 0, dsdata.to_epoch(dt(2020, 2, 1)))
+    assert list(store.query(dt(2020, 1, 1), dt(2020, 1, 2))) == alerts
+    assert store.rollup_timeseries(
+        dt(2020, 1, 1), dt(2020, 1, 1, 23, 59, 59), "day"
+    ) == dsdata.AlertColumns.from_alerts(alerts).timeseries("day")
+
+
+def test_sync_tail_does_not_wait(store):
+    store.sync(mock.Mock(return_value=[]), dt(2020, 1, 1), dt(2020, 1, 5))
+    fetch = mock.Mock(return_value=[])
+    with store._sync_lock:
+        # Another thread is fetching. Only newer alerts are missing, so
+        # this goes ahead with what is stored, and says so.
+        assert not store.sync(fetch, dt(2020, 1, 1), dt(2020, 1, 6))
+        fetch.assert_not_called()
+        assert store.sync(fetch, dt(2020, 1, 2), dt(2020, 1, 4))
+    assert store.sync(fetch, dt(2020, 1, 1), dt(2020, 1, 6))
+    fetch.assert_called_once_with(dt(2020, 1, 5, 0, 0, 1), dt(2020, 1, 6))
+
+
+def reference_timeseries(alerts, resolution, filters):
+    # The dict-based aggregation AlertColumns replaced
+    replace = {
+        "second": {},
+        "day": {},
+        "month": {"day": 1},
+        "year": {"day": 1, "month": 1},
+    }
+    data = {}
+    for alert in alerts:
+        if any(getattr(alert, key) not in values for key, values in filters.items()):
+            continue
+        timestamp = alert.timestamp
+        if resolution != "second":
+            timestamp = timestamp.date()
+        timestamp = timestamp.replace(**replace[resolution]).isoformat()
+        counts = data.setdefault(timestamp, {})
+        counts[alert.topic_code] = counts.get(alert.topic_code, 0) + 1
+    totals = {}
+    for counts in data.values():
+        for topic, count in counts.items():
+            totals[topic] = totals.get(topic, 0) + count
+        counts["Total"] = sum(counts.values())
+    totals["Total"] = sum(totals.values())
+    data["Total"] = totals
+    return data
+
+
+@pytest.mark.parametrize("resolution", ["second", "day", "month", "year"])
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {},
+        {"topic_code": {"ap", "blp", "missing"}},
+        {"sending_user": {"User1"}, "alerted_user": {"User2", "User3"}},
+    ],
+)
+def test_timeseries(resolution, filters):
+    rand = random.Random(602)
+    start = dsdata.to_epoch(dt(2019, 11, 1))
+    alerts = [
+        dsdata.DsAlert(
+            dsdata.from_epoch(timestamp),
+            f"User{rand.randrange(5)}",
+            f"User{rand.randrange(5)}",
+            rand.choice(["ap", "blp", "ipa", "cc"]),
+        )
+        for timestamp in sorted(
+            rand.randrange(start, start + 400 * 86400) for i in range(500)
+        )
+    ]
+    columns = dsdata.AlertColumns.from_alerts(alerts)
+    expected = reference_timeseries(alerts, resolution, filters)
+    result = columns.timeseries(resolution, filters)
+    assert result == expected
+    assert list(result) == list(expected)
+    assert [list(counts) for counts in result.values()] == [
+        list(counts) for counts in expected.values()
+    ]
+
+
+def test_store_columns(store):
+    alerts = [
+        dsdata.DsAlert(dt(2020, 1, 1, 12), "Alice", "Bob", "ap", 1),
+        dsdata.DsAlert(dt(2020, 1, 3, 12), "Bob", "Alice", "blp", 2),
+    ]
+    store.add(alerts, 0, dsdata.to_epoch(dt(2020, 2, 1)))
+    columns = store.columns(dt(2020, 1, 1), dt(2020, 1, 2))
+    assert len(columns) == 1
+    assert columns.user_names == ["Alice", "Bob"]
+    assert columns.timeseries("day") == {
+        "2020-01-01": {"ap": 1, "Total": 1},
+        "Total": {"ap": 1, "Total": 1},
+    }
+
+
+def test_time_shards():
+    week = datetime.timedelta(days=7)
+    assert dsdata.time_shards(dt(2020, 1, 1), dt(2020, 1, 5), week) == [
+        (dt(2020, 1, 1), dt(2020, 1, 5))
+    ]
+    assert dsdata.time_shards(dt(2020, 1, 1), dt(2020, 1, 20, 12), week) == [
+        (dt(2020, 1, 1), dt(2020, 1, 7, 23, 59, 59)),
+        (dt(2020, 1, 8), dt(2020, 1, 14, 23, 59, 59)),
+        (dt(2020, 1, 15), dt(2020, 1, 20, 12)),
+    ]
+
+
+@pytest.fixture
+def topic_index():
+    topics = {
+        "ap": {"page": "WP:ARBAP2", "case": "American politics 2"},
+        "ap2": {"page": "WP:ARBAP2", "case": "American politics 2"},
+        "a-i": {"page": "WP:ARBPIA", "case": "Palestine-Israel articles"},
+        "blp": {"page": "WP:ARBBLP", "case": "Biographies of living persons"},
+    }
+    cases = {
+        "American politics 2": {"page": "WP:ARBAP2", "codes": ["ap", "ap2"]},
+        "Palestine-Israel articles": {"page": "WP:ARBPIA", "codes": ["a-i"]},
+        "Biographies of living persons": {"page": "WP:ARBBLP", "codes": ["blp"]},
+    }
+    aliases = {"ap": "ap", "ap2": "ap", "a-i": "a-i", "blp": "blp"}
+    return dsdata.TopicIndex.build(topics, cases, aliases, 0.0)
+
+
+@pytest.mark.parametrize(
+    "topic,expected",
+    [
+        ("ap", "ap"),
+        ("ap2", "ap"),
+        ("AP2", "ap"),
+        (" ap ", "ap"),
+        ("A-I", "a-i"),
+        ("ai", "a-i"),
+        ("American politics 2", "ap"),
+        ("american_politics_2", "ap"),
+        ("Palestine-Israel articles", "a-i"),
+        ("topic code", ""),
+        ("", ""),
+        ("gg", ""),
+    ],
+)
+def test_topic_index_normalize(topic_index, topic, expected):
+    assert topic_index.normalize(topic) == expected
+
+
+def test_topic_index_ids(topic_index):
+    assert topic_index.codes == ("ap", "a-i", "blp")
+    assert topic_index.topic_id("ap2") == 0
+    assert topic_index.topic_id("blp") == 2
+    assert topic_index.topic_id("nope") == -1
+    # Normalized codes are the interned strings from the index
+    assert topic_index.normalize("AP2") is topic_index.codes[0]
+    with pytest.raises(TypeError):
+        topic_index.ids["new"] = 3
+
+
+def test_alert_filter():
+    assert dsdata.AlertFilter.compile({}) is None
+    alert_filter = dsdata.AlertFilter.compile(
+        {"sending_user": {"Bob"}, "topic_code": {"ap", "blp"}}
+    )
+    assert alert_filter.single_sender() == "Bob"
+    assert alert_filter.match_users("Anyone", "Bob")
+    assert not alert_filter.match_users("Anyone", "Carol")
+    assert alert_filter.match_topic("blp")
+    assert not alert_filter.match_topic("ipa")
+    assert alert_filter(dsdata.DsAlert(dt(2020, 1, 1), "Alice", "Bob", "ap"))
+    assert not alert_filter(dsdata.DsAlert(dt(2020, 1, 1), "Alice", "Bob", "ipa"))
+
+    alert_filter = dsdata.AlertFilter.compile({"sending_user": {"Bob", "Carol"}})
+    assert alert_filter.single_sender() is None
+
+
+def test_store_columns_filtered(store):
+    alerts = [
+        dsdata.DsAlert(dt(2020, 1, 1, 12), "Alice", "Bob", "ap", 1),
+        dsdata.DsAlert(dt(2020, 1, 2, 12), "Carol", "Bob", "blp", 2),
+        dsdata.DsAlert(dt(2020, 1, 3, 12), "Dave", "Erin", "ap", 3),
+    ]
+    store.add(alerts, 0, dsdata.to_epoch(dt(2020, 2, 1)))
+
+    def query(filters):
+        columns = store.columns(
+            dt(2020, 1, 1), dt(2020, 2, 1), dsdata.AlertFilter.compile(filters)
+        )
+        return columns.timeseries("second")
+
+    assert query({}) == dsdata.AlertColumns.from_alerts(alerts).timeseries("second")
+    for filters in [
+        {"topic_code": {"ap"}},
+        {"sending_user": {"Bob"}, "alerted_user": {"Carol", "Dave"}},
+        {"alerted_user": {"Nobody"}},
+    ]:
+        expected = dsdata.AlertColumns.from_alerts(alerts).timeseries("second", filters)
+        assert query(filters) == expected
+
+
+def random_alerts(seed, count, days):
+    rand = random.Random(seed)
+    start = dsdata.to_epoch(dt(2019, 11, 1))
+    return [
+        dsdata.DsAlert(
+            dsdata.from_epoch(timestamp),
+            f"User{rand.randrange(5)}",
+            f"User{rand.randrange(5)}",
+            rand.choice(["ap", "blp", "ipa", "cc"]),
+            log_id,
+        )
+        for log_id, timestamp in enumerate(
+            sorted(
+                rand.randrange(start, start + days * dsdata.DAY) for i in range(count)
+            )
+        )
+    ]
+
+
+@pytest.mark.parametrize("resolution", ["day", "month", "year"])
+@pytest.mark.parametrize(
+    "filters", [{}, {"topic_code": {"ap", "cc"}}, {"sending_user": {"User1"}}]
+)
+def test_rollup_timeseries(store, resolution, filters):
+    alerts = random_alerts(25, 800, 500)
+    # Added in two overlapping batches, so some alerts are added twice
+    store.add(alerts[:500], 0, dsdata.to_epoch(dt(2021, 1, 1)))
+    store.add(alerts[300:], 0, dsdata.to_epoch(dt(2021, 1, 1)))
+    start, end = dt(2019, 12, 1), dt(2020, 11, 30, 23, 59, 59)
+    alert_filter = dsdata.AlertFilter.compile(filters)
+
+    assert store.can_rollup(start, end, resolution, alert_filter)
+    expected = store.columns(start, end, alert_filter).timeseries(resolution)
+    result = store.rollup_timeseries(start, end, resolution, alert_filter)
+    assert result == expected
+    assert list(result) == list(expected)
+    assert [list(counts) for counts in result.values()] == [
+        list(counts) for counts in expected.values()
+    ]
+
+
+def test_can_rollup(store):
+    start, end = dt(2020, 1, 1), dt(2020, 1, 31, 23, 59, 59)
+    assert store.can_rollup(start, end, "month")
+    assert not store.can_rollup(start, end, "second")
+    assert not store.can_rollup(dt(2020, 1, 1, 12), end, "month")
+    assert not store.can_rollup(start, dt(2020, 1, 31, 12), "month")
+    assert not store.can_rollup(
+        start,
+        end,
+        "month",
+        dsdata.AlertFilter.compile({"alerted_user": {"Alice"}}),
+    )
+
+
+def test_old_store_emptied(tmp_path):
+    path = str(tmp_path / "dsalerts.sqlite")
+    with dsdata.sqlite3.connect(path) as conn:
+        # Version 0, which merged alerts with the same details
+        conn.execute(
+            "CREATE TABLE alerts (timestamp INTEGER, alerted_user TEXT, "
+            "sending_user TEXT, topic_code TEXT, "
+            "UNIQUE (timestamp, alerted_user, sending_user, topic_code))"
+        )
+        conn.execute("INSERT INTO alerts VALUES (1577880000, 'Alice', 'Bob', 'ap')")
+        conn.execute("CREATE TABLE coverage (start INTEGER, end INTEGER)")
+        conn.execute("INSERT INTO coverage VALUES (0, 1600000000)")
+    conn.close()
+
+    store = dsdata.AlertStore(path)
+    assert store.coverage() == []
+    assert list(store.query(dt(2020, 1, 1), dt(2020, 1, 2))) == []
+    alert = dsdata.DsAlert(dt(2020, 1, 1, 12), "Alice", "Bob", "ap", 1)
+    store.add([alert], 0, 1600000000)
+
+    # Reopening a current store keeps what it has
+    store = dsdata.AlertStore(path)
+    assert list(store.query(dt(2020, 1, 1), dt(2020, 1, 2))) == [alert]
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest
+import requests
+import unittest.mock as mock
+import sys
+import os
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/.."))
+import src.httpclient as httpclient  # noqa: E402
+
+
+def test_user_agent():
+    ua = httpclient.user_agent("hyphenator")
+    assert ua.startswith("anticompositetools/hyphenator ")
+    assert "https://anticompositetools.toolforge.org/hyphenator" in ua
+
+
+def test_get_session_shared():
+    session = httpclient.get_session("test")
+    assert httpclient.get_session("test") is session
+    assert session.headers["User-Agent"] == httpclient.user_agent("test")
+    other = httpclient.get_session("test2")
+    assert other.get_adapter("https://a") is session.get_adapter("https://b")
+
+
+def test_configure():
+    session = httpclient.get_session("test")
+    try:
+        httpclient.configure({"http_timeout": [1, 2], "http_pool_maxsize": 3})
+        assert session.timeout == (1, 2)
+        assert session.get_adapter("https://a")._pool_maxsize == 3
+    finally:
+        httpclient.configure()
+    assert session.timeout == httpclient.DEFAULT_TIMEOUT
+
+
+def test_request_timeout_and_metrics():
+    session = httpclient.get_session("test")
+    response = requests.Response()
+    response.status_code = 503
+    send = mock.MagicMock(return_value=response)
+    httpclient.metrics.clear()
+    with mock.patch("requests.Session.request", send):
+        session.get("https://example.org/foo")
+    assert send.call_args.kwargs["timeout"] == httpclient.DEFAULT_TIMEOUT
+
+    send.side_effect = requests.exceptions.ConnectTimeout()
+    with mock.patch("requests.Session.request", send):
+        with pytest.raises(requests.exceptions.ConnectTimeout):
+            session.get("https://example.org/bar", timeout=1)
+    assert send.call_args.kwargs["timeout"] == 1
+
+    host = httpclient.metrics.snapshot()["example.org"]
+    assert host["requests"] == 2
+    assert host["errors"] == 2
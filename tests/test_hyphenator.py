@@ -5,6 +5,7 @@
 
 import pytest
 import requests
+import flask
 import mwparserfromhell as mwph
 import unittest.mock as mock
 import sys
@@ -48,17 +49,18 @@ def test_get_wikitext_servererr():
     s = mock.MagicMock()
     response = mock.MagicMock()
     response.raise_for_status.side_effect = Exception("internal server error")
-    response.status_code == 500
+    response.status_code = 500
     response.text = ""
+    response.headers = {}
     mock_sleep = mock.MagicMock()
     s.get.return_value = response
 
     with mock.patch("time.sleep", mock_sleep):
-        with mock.patch("requests.get", s.get):
+        with mock.patch("src.hyphenator.session", s):
             with pytest.raises(Exception):
                 hyphenator.get_wikitext("http://example.com")
 
-    assert mock_sleep.mock_calls == [mock.call(5), mock.call(10), mock.call(15)]
+    assert len(mock_sleep.mock_calls) == 3
     assert s.get.call_count == 4
 
 
@@ -171,3 +173,202 @@ def test_get_page_url_malformed():
     )
     with pytest.raises(ValueError):
         hyphenator.get_page_url(input_url)
+
+
+def test_hyphenate():
+    code = mwph.parse("{{ISBN|0486821951}} {{cite book |isbn=978-0-393-02039-7}}")
+    assert hyphenator.hyphenate(code, convert=False) == 1
+    assert str(code) == "{{ISBN|0-486-82195-1}} {{cite book |isbn=978-0-393-02039-7}}"
+
+
+def _api_response(pages, normalized=(), continue_=None):
+    response = mock.MagicMock()
+    response.headers = {}
+    response.json.return_value = {
+        "query": {"normalized": list(normalized), "pages": pages}
+    }
+    if continue_:
+        response.json.return_value["continue"] = continue_
+    return response
+
+
+def _api_page(title, content):
+    return {
+        "title": title,
+        "revisions": [
+            {
+                "timestamp": "2020-01-02T03:04:05Z",
+                "slots": {"main": {"content": content}},
+            }
+        ],
+    }
+
+
+def test_get_wikitext_bulk():
+    titles = [f"Page {i}" for i in range(hyphenator.BATCH_SIZE + 1)]
+    titles[0] = "page 0"
+    s = mock.MagicMock()
+    s.get.side_effect = [
+        _api_response(
+            [_api_page(title, title) for title in titles[1:50]]
+            + [{"title": "Page 0", "missing": True}],
+            normalized=[{"from": "page 0", "to": "Page 0"}],
+        ),
+        _api_response([_api_page("Page 50", "text")]),
+    ]
+
+    with mock.patch("src.hyphenator.session", s):
+        pages = hyphenator.get_wikitext_bulk(titles)
+
+    assert s.get.call_count == 2
+    assert s.get.call_args_list[0][1]["params"]["titles"] == "|".join(titles[:50])
+    assert list(pages) == titles
+    assert pages["page 0"] is None
+    assert pages["Page 1"][0] == "Page 1"
+    assert pages["Page 50"][0] == "text"
+    assert pages["Page 50"][1][0] == "20200102030405"
+
+
+def test_get_wikitext_bulk_continue():
+    s = mock.MagicMock()
+    s.get.side_effect = [
+        # The size limit was reached before Big B's content was added
+        _api_response(
+            [_api_page("A", "a"), {"title": "Big B"}],
+            continue_={"rvcontinue": "123|456", "continue": "||"},
+        ),
+        _api_response([{"title": "A"}, _api_page("Big B", "b")]),
+    ]
+
+    with mock.patch("src.hyphenator.session", s):
+        pages = hyphenator.get_wikitext_bulk(["A", "Big B"])
+
+    assert s.get.call_count == 2
+    assert s.get.call_args_list[1][1]["params"]["rvcontinue"] == "123|456"
+    assert pages["A"][0] == "a"
+    assert pages["Big B"][0] == "b"
+
+
+def test_get_wikitext_bulk_same_page():
+    s = mock.MagicMock()
+    s.get.return_value = _api_response(
+        [_api_page("Foo", "text")], normalized=[{"from": "foo", "to": "Foo"}]
+    )
+
+    with mock.patch("src.hyphenator.session", s):
+        pages = hyphenator.get_wikitext_bulk(["foo", "Foo"])
+
+    assert pages["foo"][0] == pages["Foo"][0] == "text"
+
+
+def test_batch():
+    wikitexts = {
+        "Foo": ("{{ISBN|0486821951}}", ("20200101000000", "20200102000000")),
+        "Bar Baz": ("{{ISBN|0-486-82195-1}}", ("20200101000000", "20200102000000")),
+        "Missing": None,
+    }
+    with mock.patch(
+        "src.hyphenator.get_wikitext_bulk", return_value=wikitexts
+    ) as mock_bulk:
+        pages = hyphenator.batch(["Foo", "Bar Baz", "Missing", "Foo"], convert=False)
+
+    mock_bulk.assert_called_once_with(["Foo", "Bar Baz", "Missing"], "en.wikipedia.org")
+    assert [page["title"] for page in pages] == ["Foo", "Bar Baz", "Missing"]
+    assert pages[0]["count"] == 1
+    assert pages[0]["newtext"] == "{{ISBN|0-486-82195-1}}"
+    assert pages[1]["count"] == 0
+    assert pages[1]["submit_url"] == (
+        "https://en.wikipedia.org/w/index.php?title=Bar_Baz&action=submit"
+    )
+    assert "error" in pages[2]
+
+
+def test_batch_processes():
+    wikitexts = {
+        "Foo": ("{{ISBN|0486821951}}", ("20200101000000", "20200102000000")),
+        "Bar": ("{{ISBN|9780393020397}}", ("20200101000000", "20200102000000")),
+    }
+    with mock.patch("src.hyphenator.get_wikitext_bulk", return_value=wikitexts):
+        pages = hyphenator.batch(["Foo", "Bar"], convert=False, max_workers=2)
+
+    assert [page["newtext"] for page in pages] == [
+        "{{ISBN|0-486-82195-1}}",
+        "{{ISBN|978-0-393-02039-7}}",
+    ]
+
+
+def test_api_batch(tmp_path):
+    app = flask.Flask(__name__)
+    app.config["jobs_path"] = str(tmp_path / "jobs.sqlite")
+    app.register_blueprint(hyphenator.jobs.bp)
+    app.register_blueprint(hyphenator.bp)
+
+    with app.test_client() as client, mock.patch("src.jobs.start_workers"):
+        response = client.post("/hyphenator/api/batch", json={"titles": ["Foo"]})
+        assert response.status_code == 202
+        assert client.post("/hyphenator/api/batch", json={}).status_code == 400
+
+        row = hyphenator.jobs.queue.claim()
+        assert row["kind"] == "hyphenator_batch"
+        with mock.patch("src.hyphenator.batch", return_value=[]) as mock_batch:
+            hyphenator.jobs.queue.finish(
+                row["id"], hyphenator.batch_job(flask.json.loads(row["payload"]))
+            )
+        mock_batch.assert_called_once_with(["Foo"], True, "en.wikipedia.org")
+
+        response = client.get(response.headers["Location"])
+        assert response.json["result"] == {"pages": []}
+
+
+def test_normalize_isbn_memoized():
+    hyphenator.normalize_isbn.cache_clear()
+    with mock.patch(
+        "src.hyphenator.isbn.format", wraps=hyphenator.isbn.format
+    ) as mock_format:
+        assert hyphenator.normalize_isbn("0486821951", False) == "0-486-82195-1"
+        assert hyphenator.normalize_isbn("0486821951", False) == "0-486-82195-1"
+        assert hyphenator.normalize_isbn("0486821951", True) == "978-0-486-82195-5"
+        assert hyphenator.normalize_isbn("9780393020390", True) is None
+        assert hyphenator.normalize_isbn("9780393020390", True) is None
+
+    assert mock_format.call_count == 2
+    stats = hyphenator.isbn_cache_stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3
+    assert stats["hit_rate"] == 0.4
+
+
+def test_find_isbns_prefilter():
+    code = mwph.parse(
+        "{{IS<!---->BN|0486821951}} {{isbn|2}} {{ ISBNT |4}} {{cite book|ISBN=}} "
+        "{{cite|isbn = 5 }} {{cite|Isbn=6}} {{x|y={{cite|isbn=7}}}} {{&#73;SBN|9}}"
+    )
+    found = [(str(t.name), raw, para) for t, raw, para in hyphenator.find_isbns(code)]
+    assert found == [
+        ("IS<!---->BN", "0486821951", "1"),
+        (" ISBNT ", "4", "1"),
+        ("cite", "5", "isbn"),
+        ("cite", "7", "isbn"),
+        ("&#73;SBN", "9", "1"),
+    ]
+
+
+def test_find_isbns_no_isbn():
+    code = mwph.parse("{{cite web |url=https://example.com |title=Foo}}")
+    with mock.patch.object(hyphenator, "_has_isbn_param") as mock_has:
+        assert list(hyphenator.find_isbns(code)) == []
+    mock_has.assert_not_called()
+
+
+def test_flash_request_scoped():
+    app = flask.Flask(__name__)
+    with app.test_request_context():
+        hyphenator.flash("Invalid URL", "danger")
+        assert hyphenator.get_messages() == [("Invalid URL", "danger")]
+    with app.test_request_context():
+        assert hyphenator.get_messages() == []
+
+
+def test_flash_no_context():
+    hyphenator.flash("Invalid URL", "danger")
+    assert hyphenator.get_messages() == []
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest
+import unittest.mock as mock
+import sys
+import os
+
+import flask
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/.."))
+import src.jobs as jobs  # noqa: E402
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return jobs.JobQueue(str(tmp_path / "jobs.sqlite"))
+
+
+@pytest.fixture
+def handlers():
+    with mock.patch.dict(jobs.handlers, clear=True):
+        yield jobs.handlers
+
+
+def test_submit_dedup(queue):
+    job_a = queue.submit("test", {"page": "Foo"})
+    job_b = queue.submit("test", {"page": "Foo"})
+    job_c = queue.submit("test", {"page": "Bar"})
+    job_d = queue.submit("other", {"page": "Foo"})
+
+    assert job_a == job_b
+    assert len({job_a, job_c, job_d}) == 3
+    assert queue.get(job_a)["status"] == "queued"
+
+
+def test_submit_dedup_key(queue):
+    job_a = queue.submit("test", {"page": "Foo", "n": 1}, dedup_key="Foo")
+    job_b = queue.submit("test", {"page": "Foo", "n": 2}, dedup_key="Foo")
+    assert job_a == job_b
+
+
+def test_run_one(queue, handlers):
+    handlers["test"] = lambda payload: {"length": len(payload["page"])}
+    job_id = queue.submit("test", {"page": "Foo"})
+
+    assert queue.run_one() is True
+    assert queue.run_one() is False
+
+    job = queue.get(job_id)
+    assert job["status"] == "done"
+    assert job["result"] == {"length": 3}
+    # Finished jobs are reused for duplicate submissions
+    assert queue.submit("test", {"page": "Foo"}) == job_id
+
+
+def test_run_one_failed(queue, handlers):
+    handlers["test"] = mock.Mock(side_effect=ValueError("bad page"))
+    job_id = queue.submit("test", {"page": "Foo"})
+
+    assert queue.run_one() is True
+
+    job = queue.get(job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "ValueError: bad page"
+    # Failed jobs are not reused
+    assert queue.submit("test", {"page": "Foo"}) != job_id
+
+
+def test_result_ttl(queue, handlers):
+    handlers["test"] = lambda payload: None
+    with mock.patch("time.time", return_value=1000):
+        job_id = queue.submit("test", {"page": "Foo"})
+        queue.run_one()
+    with mock.patch("time.time", return_value=1000 + queue.result_ttl + 1):
+        assert queue.submit("test", {"page": "Foo"}) != job_id
+
+
+def test_claim_order_and_lost_jobs(queue):
+    with mock.patch("time.time", return_value=1000):
+        job_a = queue.submit("test", {"page": "A"})
+        job_b = queue.submit("test", {"page": "B"})
+    with mock.patch("time.time", return_value=1001):
+        assert queue.claim()["id"] == job_a
+        assert queue.claim()["id"] == job_b
+        assert queue.claim() is None
+    # A job that has been running too long is assumed lost and claimed again
+    with mock.patch("time.time", return_value=1002 + queue.timeout):
+        assert queue.claim()["id"] == job_a
+
+
+def test_status_route(tmp_path, handlers):
+    app = flask.Flask(__name__)
+    app.config["jobs_path"] = str(tmp_path / "jobs.sqlite")
+    app.register_blueprint(jobs.bp)
+    handlers["test"] = lambda payload: "result"
+    job_id = jobs.queue.submit("test", {"page": "Foo"})
+
+    with app.test_client() as client, mock.patch(
+        "src.jobs.start_workers"
+    ) as start_workers:
+        response = client.get(f"/jobs/{job_id}")
+        assert response.json["status"] == "queued"
+        # Queued by a process that may be gone, so make sure it will run
+        start_workers.assert_called_once()
+
+        jobs.queue.run_one()
+        response = client.get(f"/jobs/{job_id}")
+        assert response.json["status"] == "done"
+        assert response.json["result"] == "result"
+
+        assert client.get("/jobs/nonexistent").status_code == 404
+
+
+def test_pending_response(tmp_path, handlers):
+    app = flask.Flask(__name__)
+    app.config["jobs_path"] = str(tmp_path / "jobs.sqlite")
+    app.register_blueprint(jobs.bp)
+    handlers["test"] = mock.Mock(side_effect=ValueError("bad page"))
+    job_id = jobs.queue.submit("test", {"page": "Foo"})
+
+    with app.test_request_context(), mock.patch(
+        "src.jobs.start_workers"
+    ) as start_workers:
+        response, status = jobs.pending_response(jobs.queue.get(job_id))
+        assert status == 202
+        start_workers.assert_called_once()
+
+        jobs.queue.run_one()
+        response, status = jobs.pending_response(jobs.queue.get(job_id))
+        assert status == 500
+        assert response.json["error"] == "ValueError: bad page"
+
+
+def test_retention(queue, handlers):
+    handlers["test"] = mock.Mock(side_effect=[None, ValueError])
+    with mock.patch("time.time", return_value=1000):
+        done = queue.submit("test", {"page": "Done"})
+        failed = queue.submit("test", {"page": "Failed"})
+        queued = queue.submit("test", {"page": "Queued"})
+        queue.run_one()
+        queue.run_one()
+    with mock.patch("time.time", return_value=1000 + queue.retention - 1):
+        queue.submit("test", {"page": "Other"})
+    assert queue.get(done) is not None
+    assert queue.get(failed) is not None
+
+    with mock.patch("time.time", return_value=1001 + queue.retention):
+        queue.submit("test", {"page": "Other"})
+    assert queue.get(done) is None
+    assert queue.get(failed) is None
+    # Jobs that haven't run yet are kept however old they are
+    assert queue.get(queued)["status"] == "queued"
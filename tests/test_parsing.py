@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import pytest
+import unittest.mock as mock
+import sys
+import os
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/.."))
+import src.parsing as parsing  # noqa: E402
+import src.cache as cache  # noqa: E402
+
+
+@pytest.fixture
+def parse_cache():
+    c = cache.LRUCache(weigh=parsing._weigh, maxweight=parsing.PARSE_CACHE_SIZE)
+    with mock.patch("src.parsing.parse_cache", c):
+        yield c
+
+
+@pytest.fixture
+def text():
+    with open("tests/testdata.txt") as f:
+        return f.read()
+
+
+def test_parse_shared(parse_cache, text):
+    code = parsing.parse(text, "Page", "1")
+    assert str(code) == text
+    assert parsing.parse(text, "Page", "1") is code
+
+
+def test_parse_nokey(parse_cache, text):
+    assert parsing.parse(text) is not parsing.parse(text)
+    assert len(parse_cache) == 0
+
+
+def test_parse_changed_text(parse_cache, text):
+    code = parsing.parse(text, "Page", "1")
+    other = parsing.parse(text + "foo", "Page", "1")
+    assert other is not code
+    assert str(other) == text + "foo"
+
+
+def test_parse_mutable(parse_cache, text):
+    shared = parsing.parse(text, "Page", "1")
+    first = parsing.parse(text, "Page", "1", mutable=True)
+    assert first is not shared
+    first.insert(0, "changed")
+
+    second = parsing.parse(text, "Page", "1", mutable=True)
+    assert str(second) == text
+    assert str(parsing.parse(text, "Page", "1")) == text
+
+
+def test_parse_mutable_first(parse_cache, text):
+    code = parsing.parse(text, "Page", "1", mutable=True)
+    code.insert(0, "changed")
+
+    assert str(parsing.parse(text, "Page", "1")) == text
+    assert str(parsing.parse(text, "Page", "1", mutable=True)) == text
+
+
+def test_parse_weight(parse_cache, text):
+    parsing.parse(text, "Page", "1", mutable=True)
+    blob_only = parse_cache.weight
+    assert blob_only < parsing.TREE_WEIGHT * len(text)
+
+    # Reading it unpickles a shared tree, which has to be counted too
+    parsing.parse(text, "Page", "1")
+    assert parse_cache.weight == blob_only + parsing.TREE_WEIGHT * len(text)
+
+
+def test_parse_weight_evicts(text):
+    c = cache.LRUCache(
+        weigh=parsing._weigh, maxweight=2 * parsing.TREE_WEIGHT * len(text)
+    )
+    with mock.patch("src.parsing.parse_cache", c):
+        for revision in range(3):
+            parsing.parse(text, "Page", revision)
+    assert len(c) == 1
+
+
+def test_index():
+    code = parsing.mwparserfromhell.parse(
+        'a<ref name="x" />b<ref>{{a|{{b}}}}</ref>{{c|<ref>{{d}}</ref>}}'
+        "<references/><span>ref {{e}}</span>"
+    )
+    wikicode_index = parsing.index(code)
+
+    assert [(str(tag), str(template)) for tag, template in wikicode_index.refs] == [
+        ('<ref name="x" />', "None"),
+        ("<ref>{{a|{{b}}}}</ref>", "{{a|{{b}}}}"),
+        ("<ref>{{d}}</ref>", "{{d}}"),
+    ]
+    assert wikicode_index.top_templates == code.filter_templates(recursive=False)
+    assert wikicode_index.templates == code.filter_templates()
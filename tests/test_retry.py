@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# Copyright 2020 AntiCompositeNumber
+
+import asyncio
+import email.utils
+import time
+import pytest
+import requests
+import unittest.mock as mock
+import sys
+import os
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__) + "/.."))
+import src.retry as retry  # noqa: E402
+
+
+def make_response(status_code=200, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+
+def test_parse_retry_after_seconds():
+    assert retry.parse_retry_after(make_response(headers={"Retry-After": "5"})) == 5
+
+
+def test_parse_retry_after_date():
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    delay = retry.parse_retry_after(make_response(headers={"Retry-After": date}))
+    assert 55 < delay <= 60
+
+
+def test_parse_retry_after_missing():
+    assert retry.parse_retry_after(make_response()) is None
+    assert retry.parse_retry_after(make_response(headers={"Retry-After": "?"})) is None
+    assert retry.parse_retry_after(None) is None
+
+
+def test_backoff_exponential():
+    attempts = retry.Backoff(tries=5, base=1, jitter=False).start()
+    delays = []
+    while True:
+        delay = attempts.next_delay()
+        if delay is None:
+            break
+        delays.append(delay)
+        attempts.count += 1
+    assert delays == [1, 2, 4, 8]
+
+
+def test_backoff_deadline():
+    attempts = retry.Backoff(tries=10, base=1, deadline=5, jitter=False).start()
+    with mock.patch("time.monotonic", return_value=attempts.started + 4.5):
+        assert attempts.next_delay() is None
+
+
+def test_backoff_retry_after_beats_deadline():
+    attempts = retry.Backoff(deadline=5).start()
+    response = make_response(429, {"Retry-After": "30"})
+    assert attempts.next_delay(response) is None
+
+
+def test_call_not_retryable():
+    send = mock.MagicMock(return_value=make_response(404))
+    with mock.patch("time.sleep") as mock_sleep:
+        with pytest.raises(requests.exceptions.HTTPError):
+            retry.call(send)
+    assert send.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+def test_call_maxlag():
+    lagged = make_response(200, {"MediaWiki-API-Error": "maxlag", "Retry-After": "2"})
+    send = mock.MagicMock(side_effect=[lagged, make_response()])
+    before = retry.stats.snapshot()
+    with mock.patch("time.sleep") as mock_sleep:
+        assert retry.call(send).status_code == 200
+    mock_sleep.assert_called_once_with(2.0)
+
+    after = retry.stats.snapshot()
+    assert after["retries"] == before["retries"] + 1
+    assert after["backoff_time"] == before["backoff_time"] + 2
+
+
+def test_call_async():
+    responses = iter([make_response(503), make_response()])
+
+    async def send():
+        return next(responses)
+
+    async def no_sleep(delay):
+        pass
+
+    with mock.patch("asyncio.sleep", no_sleep):
+        response = asyncio.run(retry.call_async(send))
+    assert response.status_code == 200